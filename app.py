@@ -1,13 +1,32 @@
 # app.py - Upgraded Flask backend for a professional WhatsApp tool
 
-from flask import Flask, render_template, request, redirect, session, url_for, jsonify
+from flask import Flask, render_template, request, redirect, session, url_for, jsonify, Response, g
+import click
 import requests
+import urllib3
 import json
 import os
+import io
+import re
+import csv
+import base64
+import hmac
+import queue
+import sys
+import bisect
 import sqlite3
+import atexit
+import contextlib
 from datetime import datetime
 from dotenv import load_dotenv
-import threading # For scheduling template sends
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+try:
+    import fcntl
+except ImportError: # Windows: funnel writes are then only serialized within a process
+    fcntl = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,84 +40,1356 @@ WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 WHATSAPP_BUSINESS_ACCOUNT_ID = os.getenv("WHATSAPP_BUSINESS_ACCOUNT_ID")
 WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "mysecrettoken123") # Add this to your .env
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0") # Point at a local stub for testing
+GRAPH_TIMEOUT = (5, 30) # Connect and read timeouts (seconds) for Graph API calls
+GRAPH_MAX_RETRIES = 3 # Retries on 429/5xx and connection errors, with exponential backoff
+GRAPH_MAX_RETRY_AFTER = 30 # Upper bound (seconds) on a Retry-After we sleep for
+GRAPH_MESSAGES_PER_SECOND = float(os.getenv("GRAPH_MESSAGES_PER_SECOND", 80)) # Send throughput per phone number, across all processes
 FUNNEL_FILE = 'funnels.json'
-LOG_FILE = 'log.json'
-MESSAGES_FILE = 'messages.json' # New file for storing chat messages
+FUNNEL_RELOAD_INTERVAL = 1.0 # Seconds between checks for funnels saved by other processes
+TEMPLATE_CACHE_FILE = 'templates_cache.json' # Snapshot of the template catalog, shared by all workers
+TEMPLATE_CACHE_TTL = int(os.getenv("TEMPLATE_CACHE_TTL", 300)) # Seconds before the catalog is refreshed in the background
+TEMPLATE_REFRESH_INTERVAL = 60 # Minimum seconds between two refresh attempts (failed or forced)
+TEMPLATE_PAGE_SIZE = 100 # Templates per Graph API page
+TEMPLATE_MAX_PAGES = 50
+LOG_FILE = 'log.jsonl' # Active JSON Lines log segment, rotated to log.jsonl.1, log.jsonl.2, ...
+LEGACY_LOG_FILE = 'log.json' # Old single-array log, converted into a log segment by the store migrations
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 5 * 1024 * 1024)) # Rotate once a segment reaches this size
+LOG_MAX_AGE = int(os.getenv("LOG_MAX_AGE", 24 * 60 * 60)) # ...or once it is this many seconds old
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 10)) # Rotated segments to keep
+LOG_FLUSH_INTERVAL = 0.5 # Seconds the writer waits to batch up entries
+LOG_INDEX_FILE = 'log.jsonl.idx' # Time-bucket index over the log segments, maintained by /api/logs
+LOG_PAGE_SIZE = 100
+MESSAGES_FILE = 'messages.json' # Legacy chat store, imported into STORE_DB and renamed to *.migrated
+STORE_DB = 'store.db' # SQLite (WAL) store for chat messages, queues and broadcasts
+CONTACTS_DB = 'contacts.db'
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2)) # Threads per process draining the webhook queue
+INGEST_MAX_ATTEMPTS = 5 # Give up on a webhook payload after this many failed attempts
+INGEST_CLAIM_TIMEOUT = 300 # Seconds before a payload claimed by a dead worker is retried
+INGEST_IDLE_MAX_WAIT = 10 # Longest poll interval of an idle ingest worker (local webhooks wake it at once)
+INGEST_MAINTENANCE_INTERVAL = 60 # Seconds between passes that requeue stale claims and prune failed payloads
+INGEST_FAILED_RETENTION = 7 * 86400 # Seconds failed payloads are kept for inspection
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 8)) # Funnel steps sent in parallel per process
+SCHEDULER_MAX_ATTEMPTS = 3 # Attempts per funnel step before it is marked failed
+SCHEDULER_RETRY_DELAY = 30 # Seconds before a failed step is retried (times the attempt number)
+SCHEDULER_POLL_INTERVAL = 1.0 # Longest the dispatcher sleeps, so steps queued by other processes are seen
+SCHEDULER_CLAIM_TIMEOUT = 300 # Seconds before a step claimed by a dead process is sent again
+SCHEDULER_RETENTION = 7 * 86400 # Seconds sent and failed steps are kept after they were due
+SCHEDULER_PRUNE_INTERVAL = 3600 # Seconds between deletions of steps older than SCHEDULER_RETENTION
+FLOW_CONCURRENCY = int(os.getenv("FLOW_CONCURRENCY", 16)) # Flow sessions advanced in parallel per process
+FLOW_MAX_STEPS = 100 # Nodes a session may pass through without waiting (guards against branch loops)
+FLOW_CLAIM_TIMEOUT = 300 # Seconds before a session claimed by a dead process is run again
+FLOW_RELOAD_INTERVAL = 1.0 # Seconds between checks for flows saved by other processes
+FLOW_API_TIMEOUT = (5, 15) # Connect and read timeouts (seconds) for flow API nodes
+FLOW_API_MAX_BODY = 16 * 1024 # Larger API responses are not kept in the session variables
+EVENT_POLL_INTERVAL = 0.25 # Seconds between checks for inbox events published by other processes
+EVENT_RETENTION = 10000 # Latest events kept so reconnecting clients can catch up (Last-Event-ID)
+EVENT_QUEUE_SIZE = 1000 # Undelivered events per client before it is disconnected (it reconnects and catches up)
+EVENT_KEEPALIVE = 15 # Seconds between keep-alive comments on an idle event stream
+EVENT_STREAM_MAX_AGE = 300 # Streams are closed after this long so workers are recycled; browsers reconnect
+BROADCAST_CHUNK_SIZE = 500 # Recipients read, sent and checkpointed together
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 16)) # Parallel sends per running broadcast
+BROADCAST_CLAIM_TIMEOUT = 120 # Seconds without a heartbeat before another process resumes a broadcast
+BROADCAST_HEARTBEAT_INTERVAL = 15 # Seconds between heartbeats while a chunk is being sent
+DELIVERY_ORPHAN_TTL = 3600 # Seconds a status for a not-yet-stored message is kept for it
+METRICS_DIR = 'metrics' # Per-process metric snapshots merged by /metrics, and profiler stacks
+METRICS_FLUSH_INTERVAL = 5 # Seconds between metric snapshots (and profiler start/stop checks)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # Lets scrapers read /metrics with "Authorization: Bearer <token>"
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "").lower() in ("1", "true", "yes") # Opt-in: /metrics without login or token
+PROFILER_INTERVAL = 0.01 # Seconds between profiler samples
+PROFILER_MAX_SECONDS = 600 # A forgotten profiler stops sampling after this long
 
 # --- Dummy Data and Utility Functions ---
 USERS = {"admin": "admin123"}
-funnels = {}
-if os.path.exists(FUNNEL_FILE):
-    with open(FUNNEL_FILE) as f:
-        funnels = json.load(f)
+
+_background_pids = {}
+_background_lock = threading.Lock()
+
+def start_background_thread(name, target, count=1):
+    """
+    Starts `count` daemon threads running target, once per process.
+    Threads don't survive a fork, so each gunicorn worker starts its own.
+    """
+    if _background_pids.get(name) == os.getpid():
+        return
+    with _background_lock:
+        if _background_pids.get(name) == os.getpid():
+            return
+        for i in range(count):
+            threading.Thread(target=target, name=f"{name}-{i}", daemon=True).start()
+        _background_pids[name] = os.getpid()
+
+# --- Metrics ---
+# Counters and latency histograms are kept in memory per process (a dict
+# update under a lock per observation). Every METRICS_FLUSH_INTERVAL each
+# process writes a snapshot to METRICS_DIR/<pid>.json, and /metrics merges
+# the snapshots of all live workers with its own, so a scrape that lands on
+# any gunicorn worker sees the whole app. Queue depths are read from the
+# store at scrape time.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "Flask request latency by route"),
+    "graph_api_request_duration_seconds": ("histogram", "Graph API call latency, including retries"),
+    "graph_api_retries_total": ("counter", "Graph API calls retried after a 429/5xx or connection error"),
+    "store_operation_duration_seconds": ("histogram", "Latency of message and contact store reads and writes"),
+    "dispatch_duration_seconds": ("histogram", "Time to run one funnel step, flow session or broadcast chunk"),
+    "webhooks_received_total": ("counter", "Webhook POST requests accepted"),
+    "webhook_payloads_processed_total": ("counter", "Webhook payloads processed by the ingest workers, by outcome"),
+    "messages_received_total": ("counter", "New incoming messages stored"),
+    "messages_sent_total": ("counter", "Outgoing messages accepted by the Graph API"),
+    "messages_failed_total": ("counter", "Outgoing messages that could not be sent"),
+    "event_stream_clients": ("gauge", "Open /api/events streams"),
+    "log_queue_entries": ("gauge", "Log entries waiting for the log writer"),
+    "webhook_queue_payloads": ("gauge", "Webhook payloads in the ingest queue, by status"),
+    "scheduled_steps": ("gauge", "Funnel steps not yet sent, by status"),
+    "flow_sessions": ("gauge", "Flow sessions in progress, by status"),
+    "broadcasts": ("gauge", "Broadcasts not yet finished, by status"),
+}
+
+class Metrics:
+    def __init__(self):
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> per-bucket counts (+Inf last), then the sum
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            values[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+            values[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """JSON-serializable copy of this process's metrics, plus its point-in-time gauges."""
+        with self.lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()]
+        gauges = [
+            ["event_stream_clients", [], len(event_bus.subscribers)],
+            ["log_queue_entries", [], log_writer.queue.qsize()],
+        ]
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+metrics = Metrics()
+
+def write_metrics_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # Exists but owned by someone else
+    return True
+
+def collect_metric_snapshots():
+    """This process's snapshot and those of the other live workers; files of dead workers are removed."""
+    snapshots = [metrics.snapshot()]
+    if not os.path.isdir(METRICS_DIR):
+        return snapshots
+    for filename in os.listdir(METRICS_DIR):
+        pid, _, ext = filename.partition('.')
+        if ext != 'json' or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        path = os.path.join(METRICS_DIR, filename)
+        if not process_alive(int(pid)):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def escape_label_value(value):
+    """Escapes a label value for the Prometheus text format (backslash, quote, newline)."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, extra=None):
+    pairs = [f'{key}="{escape_label_value(value)}"' for key, value in labels] + ([extra] if extra else [])
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render_metrics():
+    """Merges all workers' snapshots and the store's queue depths into Prometheus text format."""
+    merged = {"counter": {}, "gauge": {}, "histogram": {}}
+    for snapshot in collect_metric_snapshots():
+        for kind, entries in (("counter", snapshot['counters']), ("gauge", snapshot['gauges'])):
+            for name, labels, value in entries:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            total = merged["histogram"].setdefault(key, [0] * len(values))
+            merged["histogram"][key] = [a + b for a, b in zip(total, values)]
+
+    conn = get_store()
+    for name, table, statuses in (
+        ("webhook_queue_payloads", "webhook_queue", ('pending', 'processing', 'failed')),
+        ("scheduled_steps", "scheduled_steps", ('pending', 'sending')),
+        ("flow_sessions", "flow_sessions", ('waiting', 'input', 'running')),
+        ("broadcasts", "broadcasts", ('pending', 'running')),
+    ):
+        counts = dict(conn.execute(
+            f"SELECT status, COUNT(*) FROM {table} WHERE status IN ({','.join('?' * len(statuses))}) GROUP BY status",
+            statuses
+        ).fetchall())
+        for status in statuses:
+            merged["gauge"][(name, (('status', status),))] = counts.get(status, 0)
+
+    lines = []
+    for kind in ("counter", "gauge", "histogram"):
+        by_name = {}
+        for (name, labels), value in merged[kind].items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, ('', name))[1]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name]):
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{format_labels(labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+# --- Sampling Profiler ---
+# An optional wall-clock profiler: a thread samples every thread's stack
+# each PROFILER_INTERVAL and counts identical stacks, which are dumped in
+# the collapsed "frame;frame;frame count" format read by flamegraph.pl and
+# speedscope. POST /api/profiler/start writes METRICS_DIR/profiler.json and
+# every worker starts sampling when its metrics flusher sees that file;
+# each worker dumps its stacks to METRICS_DIR/<pid>.folded, which
+# POST /api/profiler/stop merges. Sampling stops on its own after
+# PROFILER_MAX_SECONDS.
+class SamplingProfiler:
+    def __init__(self):
+        self.stacks = {}
+        self.running = False
+        self.run_id = None # started_at of the profiler.json this process last acted on
+        self.dirty = False # Stacks changed since the last dump
+        self.lock = threading.Lock()
+
+    def start(self, interval, run_id=None):
+        with self.lock:
+            if self.running:
+                return
+            self.stacks, self.running, self.run_id = {}, True, run_id
+        threading.Thread(target=self._run, args=(interval,), name="profiler", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self, interval):
+        own_id, started = threading.get_ident(), time.monotonic()
+        while self.running and time.monotonic() - started < PROFILER_MAX_SECONDS:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack = ';'.join([names.get(thread_id, str(thread_id))] + frames[::-1])
+                with self.lock:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.dirty = True
+            time.sleep(interval)
+        self.running = False
+
+    def collapsed(self):
+        with self.lock:
+            self.dirty = False
+            return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+profiler = SamplingProfiler()
+
+def profiler_request():
+    """The profiler settings written by /api/profiler/start, or None when profiling is off."""
+    try:
+        with open(os.path.join(METRICS_DIR, 'profiler.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def dump_profile():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.folded")
+    with open(f"{path}.tmp", 'w') as f:
+        f.write(profiler.collapsed())
+    os.replace(f"{path}.tmp", path)
+
+def sync_profiler():
+    """Starts or stops this process's profiler to match profiler.json and dumps new stacks."""
+    settings = profiler_request()
+    if settings and not profiler.running and profiler.run_id != settings.get('started_at'):
+        # run_id keeps a run that hit PROFILER_MAX_SECONDS from starting again
+        profiler.start(settings.get('interval', PROFILER_INTERVAL), settings.get('started_at'))
+    elif not settings and profiler.running:
+        profiler.stop()
+    if profiler.dirty:
+        dump_profile()
+
+def metrics_flush_loop():
+    while True:
+        threading.Event().wait(METRICS_FLUSH_INTERVAL)
+        try:
+            write_metrics_snapshot()
+            sync_profiler()
+        except OSError as e:
+            log(f"❌ Could not write metrics snapshot: {e}", log_type="WARNING")
+
+def ensure_metrics_flusher():
+    """Starts this process's metrics/profiler flusher (again after a fork)."""
+    start_background_thread("metrics-flusher", metrics_flush_loop)
+
+# --- Logging ---
+# log() only puts the entry on a queue; a background thread appends queued
+# entries to LOG_FILE in batches (one write per batch) and rotates segments
+# by size and age. Appends use O_APPEND so several gunicorn workers can share
+# the file, and a writer reopens LOG_FILE when another process rotated it.
+class LogWriter:
+    def __init__(self, path, max_bytes, max_age, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock() # Guards the file handle, rotation and clearing
+        self.file = None
+        self.opened_at = None
+        self.thread = None
+        self.pid = None
+
+    def write(self, entry):
+        """Queues an entry for the writer thread (never blocks on disk)."""
+        self.ensure_started()
+        self.queue.put(entry)
+
+    def ensure_started(self):
+        # Threads don't survive a fork, so gunicorn workers each start their own
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.file = None
+                    self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                    self.thread.start()
+                    self.pid = os.getpid()
+
+    def flush(self, timeout=5):
+        """Blocks until every entry queued so far has been written (without waiting out LOG_FLUSH_INTERVAL)."""
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def segments(self):
+        """Returns the existing log segments, newest first."""
+        paths = [self.path] + [f"{self.path}.{i}" for i in range(1, self.backup_count + 1)]
+        return [path for path in paths if os.path.exists(path)]
+
+    def clear(self):
+        """Deletes every segment; the writer starts a fresh one on its next batch."""
+        self.flush()
+        with self.lock:
+            self._close()
+            for path in self.segments() + [LOG_INDEX_FILE]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL # At most this late after the batch's first entry
+            try:
+                # A flush() waiter ends the batch, so it is not held up by the deadline
+                while len(batch) < 1000 and not isinstance(batch[-1], threading.Event):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                pass
+            entries = [item for item in batch if isinstance(item, dict)]
+            try:
+                if entries:
+                    self._write_batch(entries)
+            except OSError as e:
+                print(f"Failed to write log batch: {e}")
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write_batch(self, entries):
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode("utf-8")
+        with self.lock:
+            self._open()
+            os.write(self.file, data)
+            if os.fstat(self.file).st_size >= self.max_bytes or datetime.now().timestamp() - self.opened_at >= self.max_age:
+                self._rotate()
+
+    def _open(self):
+        if self.file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self._close() # Rotated or cleared by another process
+        self.file = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.opened_at = self._first_entry_time()
+
+    def _first_entry_time(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return datetime.fromisoformat(json.loads(f.readline())['timestamp']).timestamp()
+        except (OSError, ValueError, KeyError):
+            return datetime.now().timestamp()
+
+    def _close(self):
+        if self.file is not None:
+            os.close(self.file)
+            self.file = None
+
+    def _rotate(self):
+        self._close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if os.path.exists(self.path):
+            os.replace(self.path, f"{self.path}.1")
+
+log_writer = LogWriter(LOG_FILE, LOG_MAX_BYTES, LOG_MAX_AGE, LOG_BACKUP_COUNT)
+atexit.register(log_writer.flush)
 
 def log(msg, log_type="INFO"):
     """
-    Writes a structured log entry to the log.json file.
+    Queues a structured log entry for the background log writer.
     Args:
         msg (str): The log message.
         log_type (str): The type of log (e.g., INFO, WARNING, ERROR).
     """
-    new_entry = {
+    log_writer.write({
         "timestamp": datetime.now().isoformat(),
         "type": log_type,
         "message": msg
-    }
-    logs = []
-    if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
+    })
+
+# --- Log Queries ---
+# /api/logs reads segments backwards from the tail, so the newest page costs
+# the same however large the log is. Each segment is split into hourly
+# buckets (byte range, time range and per-level counts) kept in LOG_INDEX_FILE.
+# Rotated segments are indexed once; the active one only has its newly
+# appended bytes scanned. Filtered queries skip buckets that cannot match.
+_log_index_lock = threading.Lock()
+
+def index_log_segment(path, segment_index):
+    """Brings one segment's bucket index up to date with the bytes on disk."""
+    size = os.path.getsize(path)
+    if segment_index.get('size', 0) > size:
+        segment_index = {} # Truncated or replaced, index again
+    buckets = segment_index.setdefault('buckets', [])
+    offset = segment_index.get('size', 0)
+    if offset == size:
+        return segment_index
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break # Line still being written
+            start, offset = offset, offset + len(line)
+            try:
+                entry = json.loads(line)
+                timestamp, level = entry['timestamp'], entry.get('type', 'INFO')
+            except (ValueError, KeyError, TypeError):
+                continue
+            if buckets and buckets[-1]['key'] == timestamp[:13] and buckets[-1]['end'] == start:
+                bucket = buckets[-1]
+            else:
+                bucket = {"key": timestamp[:13], "start": start, "end": start,
+                          "min_ts": timestamp, "max_ts": timestamp, "levels": {}}
+                buckets.append(bucket)
+            bucket['end'] = offset
+            bucket['min_ts'] = min(bucket['min_ts'], timestamp)
+            bucket['max_ts'] = max(bucket['max_ts'], timestamp)
+            bucket['levels'][level] = bucket['levels'].get(level, 0) + 1
+    segment_index['size'] = offset
+    return segment_index
+
+def load_log_index():
+    """Returns {segment path: (inode, bucket index)}, indexing any new log data."""
+    with _log_index_lock:
         try:
-            with open(LOG_FILE, 'r') as f:
-                logs = json.load(f)
-        except json.JSONDecodeError:
-            logs = [] # Corrupted file, start fresh
-    
-    logs.append(new_entry)
-    with open(LOG_FILE, 'w') as f:
-        json.dump(logs, f, indent=2)
+            with open(LOG_INDEX_FILE, 'r') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = {}
+        index, result = {}, {}
+        for path in log_writer.segments():
+            try:
+                inode = str(os.stat(path).st_ino)
+                index[inode] = index_log_segment(path, stored.get(inode, {}))
+            except OSError:
+                continue # Rotated away while we were looking
+            result[path] = (inode, index[inode])
+        if index != stored:
+            tmp_path = f"{LOG_INDEX_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, LOG_INDEX_FILE)
+        return result
+
+def read_lines_reversed(path, start, end, block_size=64 * 1024):
+    """Yields (offset, line) for the complete lines in [start, end) of a file, last line first."""
+    with open(path, 'rb') as f:
+        position, tail = end, b""
+        while position > start:
+            read_size = min(block_size, position - start)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + tail).split(b"\n")
+            tail = lines.pop(0) # May continue in the previous block
+            line_end = position + len(tail) + 1
+            offsets = []
+            for line in lines:
+                offsets.append(line_end)
+                line_end += len(line) + 1
+            for line_start, line in zip(reversed(offsets), reversed(lines)):
+                if line:
+                    yield line_start, line
+        if tail:
+            yield start, tail
+
+def query_logs(level=None, since=None, until=None, search=None, cursor=None, limit=LOG_PAGE_SIZE):
+    """
+    Returns (entries, next_cursor) with entries newest first.
+    The cursor is "<segment inode>:<byte offset>" of the last entry returned,
+    which stays valid when the segment is later rotated to a new name.
+    """
+    log_writer.flush()
+    cursor_inode, cursor_offset = None, None
+    if cursor:
+        cursor_inode, _, cursor_offset = cursor.partition(':')
+        cursor_offset = int(cursor_offset or 0)
+    search = search.casefold() if search else None
+    entries = []
+    for path, (inode, segment_index) in load_log_index().items():
+        if cursor_inode is not None:
+            if inode != cursor_inode:
+                continue # Newer than the cursor's segment
+            cursor_inode, upper = None, cursor_offset
+        else:
+            upper = segment_index['size']
+        for bucket in reversed(segment_index['buckets']):
+            if bucket['start'] >= upper:
+                continue
+            if (since and bucket['max_ts'] < since) or (until and bucket['min_ts'] > until):
+                continue
+            if level and level not in bucket['levels']:
+                continue
+            for offset, line in read_lines_reversed(path, bucket['start'], min(bucket['end'], upper)):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if level and entry.get('type') != level:
+                    continue
+                if (since and entry['timestamp'] < since) or (until and entry['timestamp'] > until):
+                    continue
+                if search and search not in entry.get('message', '').casefold():
+                    continue
+                entries.append(entry)
+                if len(entries) == limit:
+                    return entries, f"{inode}:{offset}"
+    return entries, None
+
+def import_legacy_log(conn=None):
+    """
+    Converts the old log.json array into the oldest log segment, then renames
+    it to log.json.migrated. Runs once as a store migration, so concurrently
+    booting workers don't convert it twice. Segments other workers are
+    appending to are never touched.
+    """
+    try:
+        with open(LEGACY_LOG_FILE, 'r') as f:
+            entries = json.loads(f.read() or '[]')
+    except FileNotFoundError:
+        return
+    except ValueError:
+        entries = [] # Corrupted file, start fresh
+    rotated = len([path for path in log_writer.segments() if path != LOG_FILE])
+    if entries and rotated < LOG_BACKUP_COUNT:
+        tmp_path = f"{LOG_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, f"{LOG_FILE}.{rotated + 1}")
+    os.replace(LEGACY_LOG_FILE, f"{LEGACY_LOG_FILE}.migrated")
+
+# --- Message Store ---
+# Messages live in an append-only SQLite table indexed by phone number, so a
+# new message is a single INSERT and reading one conversation never touches
+# the others. Each thread keeps its own connection; WAL lets readers run
+# alongside the single writer.
+_store_local = threading.local()
+_store_init_lock = threading.Lock()
+_store_ready = False
+
+STORE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone_number TEXT NOT NULL,
+        text TEXT,
+        timestamp TEXT NOT NULL,
+        is_from_me INTEGER NOT NULL,
+        type TEXT NOT NULL DEFAULT 'text'
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_messages_phone ON messages (phone_number, id)',
+    # One row per conversation holding its latest message, kept current by save_chat_message
+    '''
+    CREATE TABLE IF NOT EXISTS chats (
+        phone_number TEXT PRIMARY KEY,
+        last_message_id INTEGER NOT NULL,
+        last_message TEXT,
+        timestamp TEXT NOT NULL,
+        is_from_me INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_chats_timestamp ON chats (timestamp, phone_number)',
+    # Raw webhook bodies waiting for the ingest workers
+    '''
+    CREATE TABLE IF NOT EXISTS webhook_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        received_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        claimed_at REAL,
+        last_error TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_webhook_queue_status ON webhook_queue (status, id)',
+    # Funnel steps waiting to be sent; (status, due_at) is the scheduler's priority queue
+    '''
+    CREATE TABLE IF NOT EXISTS scheduled_steps (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        due_at REAL NOT NULL,
+        phone_number TEXT NOT NULL,
+        funnel TEXT NOT NULL,
+        template TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        claimed_at REAL,
+        last_error TEXT,
+        created_at TEXT NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_scheduled_steps_due ON scheduled_steps (status, due_at)',
+    'CREATE INDEX IF NOT EXISTS idx_scheduled_steps_funnel ON scheduled_steps (funnel, status)',
+    # Template broadcasts to contact segments; last_contact_id is the resume checkpoint
+    '''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        template TEXT NOT NULL,
+        language TEXT NOT NULL,
+        city TEXT,
+        tag TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        last_contact_id INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        heartbeat_at REAL,
+        created_at TEXT NOT NULL,
+        finished_at TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status, id)',
+    '''
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        phone_number TEXT NOT NULL,
+        status TEXT NOT NULL,
+        error TEXT,
+        sent_at TEXT NOT NULL,
+        PRIMARY KEY (broadcast_id, phone_number)
+    )
+    ''',
+    # Graph flows built in automation.html, stored as the editor's JSON
+    '''
+    CREATE TABLE IF NOT EXISTS flows (
+        name TEXT PRIMARY KEY,
+        graph TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    # One row per contact running a flow: current node, variables and when to continue
+    '''
+    CREATE TABLE IF NOT EXISTS flow_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        flow TEXT NOT NULL,
+        phone_number TEXT NOT NULL,
+        node TEXT NOT NULL,
+        variables TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'waiting',
+        wake_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        claimed_at REAL,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_flow_sessions_due ON flow_sessions (status, wake_at)',
+    'CREATE INDEX IF NOT EXISTS idx_flow_sessions_phone ON flow_sessions (phone_number, status)',
+    # Inbox updates (new messages, delivery statuses) for the event streams of all processes
+    '''
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''',
+    # Delivery counters per "template:<name>", "funnel:<name>", "flow:<name>" and "broadcast:<id>"
+    '''
+    CREATE TABLE IF NOT EXISTS delivery_stats (
+        key TEXT PRIMARY KEY,
+        sent INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        read INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    # Statuses that arrived before their outgoing message was stored (e.g. mid broadcast chunk)
+    '''
+    CREATE TABLE IF NOT EXISTS delivery_orphans (
+        wamid TEXT PRIMARY KEY,
+        status INTEGER NOT NULL,
+        received_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_delivery_orphans_received ON delivery_orphans (received_at)',
+    # Shared token buckets, see TokenBucket
+    '''
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    # A contact runs each flow at most once at a time
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_flow_sessions_active ON flow_sessions (flow, phone_number)
+    WHERE status IN ('waiting', 'input', 'running')
+    ''',
+]
+
+CHAT_PAGE_SIZE = 50
+HISTORY_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def connect_db(path):
+    """Opens a SQLite connection tuned for many short concurrent transactions."""
+    conn = sqlite3.connect(path, timeout=30, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
 
-def load_messages():
-    """Loads all messages from messages.json."""
-    if os.path.exists(MESSAGES_FILE) and os.path.getsize(MESSAGES_FILE) > 0:
+def apply_migrations(conn, migrations, schema=()):
+    """
+    Brings a database up to len(migrations), tracked in PRAGMA user_version,
+    after running the idempotent `schema` statements. Each migration is a
+    function taking the connection, or a list of SQL statements and such
+    functions; it must not commit. Every migration runs in its own
+    BEGIN IMMEDIATE transaction that re-reads and bumps the version, so
+    processes starting together apply each migration exactly once.
+    """
+    pending_schema = schema
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
         try:
-            with open(MESSAGES_FILE, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            log("❌ messages.json file is corrupted. Starting fresh.", log_type="ERROR")
-            return {} # Return empty dict if corrupted
-    return {}
-
-def save_messages_to_file(all_messages):
-    """Saves the entire messages dictionary to messages.json."""
-    with open(MESSAGES_FILE, 'w') as f:
-        json.dump(all_messages, f, indent=2)
-
-def save_chat_message(phone_number, message_text, is_from_me, message_type="text"):
-    """
-    Saves a single chat message to the messages.json structure.
-    Messages are stored per phone number.
-    """
-    all_messages = load_messages()
-    if phone_number not in all_messages:
-        all_messages[phone_number] = []
-    
-    new_message = {
-        "id": str(len(all_messages[phone_number]) + 1), # Simple ID
+            for statement in pending_schema:
+                conn.execute(statement)
+            pending_schema = ()
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < len(migrations):
+                migration = migrations[version]
+                for step in (migration if isinstance(migration, list) else [migration]):
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if version >= len(migrations):
+            return
+
+def add_column(conn, table, column, definition):
+    """ALTER TABLE ADD COLUMN, skipped when the column already exists."""
+    if column not in {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def get_store():
+    """Returns this thread's connection to the message store, creating it on first use."""
+    conn = getattr(_store_local, 'conn', None)
+    if conn is None:
+        conn = connect_db(STORE_DB)
+        try:
+            init_store(conn)
+        except BaseException:
+            conn.close()
+            raise
+        _store_local.conn = conn # Only once the store is fully migrated
+    return conn
+
+def init_store(conn):
+    """Creates the store schema once per process and imports the legacy messages.json."""
+    global _store_ready
+    if _store_ready:
+        return
+    with _store_init_lock:
+        if _store_ready:
+            return
+        apply_migrations(conn, STORE_MIGRATIONS, schema=STORE_SCHEMA)
+        _store_ready = True
+
+def import_legacy_messages(conn):
+    """Copies conversations from messages.json into the store, then renames it to messages.json.migrated (runs once)."""
+    try:
+        with open(MESSAGES_FILE, 'r') as f:
+            legacy = json.loads(f.read() or '{}')
+    except FileNotFoundError:
+        return
+    except ValueError:
+        log("❌ messages.json file is corrupted. Skipping import.", log_type="ERROR")
+        legacy = {}
+    rows = []
+    for phone_number, messages in legacy.items():
+        for msg in messages:
+            rows.append((phone_number, msg.get('text'), msg.get('timestamp') or datetime.now().isoformat(),
+                         1 if msg.get('isFromMe') else 0, msg.get('type', 'text')))
+    rows.sort(key=lambda row: row[2]) # Keep ids in chronological order
+    conn.executemany('''
+        INSERT INTO messages (phone_number, text, timestamp, is_from_me, type)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    os.replace(MESSAGES_FILE, f"{MESSAGES_FILE}.migrated")
+    log(f"Imported {len(rows)} messages from {MESSAGES_FILE}", log_type="INFO")
+
+def backfill_chat_index(conn):
+    """Builds the chats index from existing messages (runs once)."""
+    conn.execute('''
+        INSERT OR REPLACE INTO chats (phone_number, last_message_id, last_message, timestamp, is_from_me)
+        SELECT m.phone_number, m.id, m.text, m.timestamp, m.is_from_me FROM messages m
+        JOIN (SELECT MAX(id) AS id FROM messages GROUP BY phone_number) last ON last.id = m.id
+    ''')
+
+def add_message_wamid(conn):
+    """Adds the WhatsApp message id column; its unique index makes redelivered messages no-ops."""
+    add_column(conn, 'messages', 'wamid', 'TEXT')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_wamid ON messages (wamid) WHERE wamid IS NOT NULL')
+
+def add_message_delivery(conn):
+    """Adds the delivery state of outgoing messages and what sent them (template, funnel/flow/broadcast)."""
+    add_column(conn, 'messages', 'status', 'INTEGER NOT NULL DEFAULT 0') # See DELIVERY_STATUSES
+    add_column(conn, 'messages', 'template', 'TEXT')
+    add_column(conn, 'messages', 'source', 'TEXT')
+
+# Each entry upgrades the store by one PRAGMA user_version
+STORE_MIGRATIONS = [import_legacy_messages, backfill_chat_index, add_message_wamid, add_message_delivery,
+                    import_legacy_log]
+
+def parse_limit(default, maximum=MAX_PAGE_SIZE):
+    """Reads the ?limit= query argument, clamped to [1, maximum]."""
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, maximum))
+
+def message_row_to_dict(row):
+    """Converts a messages row into the JSON shape the inbox expects."""
+    return {
+        "id": str(row['id']),
+        "text": row['text'],
+        "timestamp": row['timestamp'],
+        "isFromMe": bool(row['is_from_me']),
+        "type": row['type'],
+        "status": DELIVERY_STATUSES[row['status']]
+    }
+
+def get_chat_messages(phone_number, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Returns messages of a single conversation, oldest first, plus whether more exist.
+    Message ids increase monotonically, so they double as stable cursors:
+    - after: only messages newer than this id (delta sync), oldest first
+    - before: the newest `limit` messages older than this id
+    - neither: the newest `limit` messages of the conversation
+    """
+    conn = get_store()
+    with metrics.timer('store_operation_duration_seconds', operation='read_history'):
+        if after is not None:
+            rows = conn.execute('''
+                SELECT * FROM messages WHERE phone_number = ? AND id > ? ORDER BY id LIMIT ?
+            ''', (phone_number, after, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            rows = conn.execute('''
+                SELECT * FROM messages WHERE phone_number = ? AND id < ? ORDER BY id DESC LIMIT ?
+            ''', (phone_number, before if before is not None else 2 ** 63 - 1, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit][::-1]
+    return [message_row_to_dict(row) for row in rows], has_more
+
+def update_chat_index(conn, phone_number, message_id, message_text, timestamp, is_from_me):
+    """Points the conversation's chats row at a newly stored message."""
+    conn.execute('''
+        INSERT INTO chats (phone_number, last_message_id, last_message, timestamp, is_from_me)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (phone_number) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_message = excluded.last_message,
+            timestamp = excluded.timestamp,
+            is_from_me = excluded.is_from_me
+        WHERE excluded.last_message_id > chats.last_message_id
+    ''', (phone_number, message_id, message_text, timestamp, 1 if is_from_me else 0))
+
+def insert_chat_messages(conn, batch):
+    """Inserts messages inside the caller's transaction; see save_chat_messages."""
+    timestamp = datetime.now().isoformat()
+    stored = []
+    for item in batch:
+        # Outgoing messages accepted by the Graph API (they have a wamid) start out as sent
+        tracked = item['is_from_me'] and item.get('wamid')
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO messages (phone_number, text, timestamp, is_from_me, type, wamid, status, template, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (item['phone_number'], item['text'], timestamp, 1 if item['is_from_me'] else 0,
+              item.get('type', 'text'), item.get('wamid'), DELIVERY_SENT if tracked else 0,
+              item.get('template'), item.get('source')))
+        if cursor.rowcount == 0:
+            continue
+        if tracked:
+            keys = delivery_stat_keys(item.get('template'), item.get('source'))
+            count_delivery(conn, keys, 0, DELIVERY_SENT)
+            orphan = conn.execute('SELECT status FROM delivery_orphans WHERE wamid = ?', (item['wamid'],)).fetchone()
+            if orphan:
+                conn.execute('DELETE FROM delivery_orphans WHERE wamid = ?', (item['wamid'],))
+            if orphan and orphan[0] > DELIVERY_SENT:
+                conn.execute('UPDATE messages SET status = ? WHERE id = ?', (orphan[0], cursor.lastrowid))
+                count_delivery(conn, keys, DELIVERY_SENT, orphan[0])
+        update_chat_index(conn, item['phone_number'], cursor.lastrowid, item['text'], timestamp, item['is_from_me'])
+        stored.append(dict(item, id=str(cursor.lastrowid), timestamp=timestamp))
+        publish_event(conn, 'message', {
+            "phone_number": item['phone_number'],
+            "message": {
+                "id": str(cursor.lastrowid),
+                "text": item['text'],
+                "timestamp": timestamp,
+                "isFromMe": bool(item['is_from_me']),
+                "type": item.get('type', 'text'),
+                "status": DELIVERY_STATUSES[DELIVERY_SENT if tracked else 0]
+            }
+        })
+    return stored
+
+def save_chat_messages(batch, on_stored=None):
+    """
+    Appends several chat messages in a single transaction and returns the stored ones.
+    Each item is a dict with phone_number, text, is_from_me, type and an optional
+    WhatsApp message id (wamid); items whose wamid is already stored are skipped.
+    Outgoing items may name the template and source ("funnel:<name>", ...) whose
+    delivery counters they count towards, see count_delivery.
+    `on_stored(conn, stored)` runs inside the same transaction, so writes that
+    follow from the new messages commit (or roll back) together with them.
+    """
+    conn = get_store()
+    with metrics.timer('store_operation_duration_seconds', operation='save_messages'), conn:
+        stored = insert_chat_messages(conn, batch)
+        if on_stored is not None and stored:
+            on_stored(conn, stored)
+    if stored:
+        event_bus.notify()
+    for item in stored:
+        log(f"Chat message saved for {item['phone_number']}: {'Me ->' if item['is_from_me'] else '-> Me'} {item['text'][:50]}...", log_type="INFO")
+    return stored
+
+def save_chat_message(phone_number, message_text, is_from_me, message_type="text", wamid=None,
+                      template=None, source=None):
+    """
+    Appends a single chat message to the store and returns it.
+    Messages are stored per phone number. When a WhatsApp message id is given
+    and that message was already stored, nothing is written and None is returned.
+    """
+    stored = save_chat_messages([{
+        "phone_number": phone_number,
         "text": message_text,
-        "timestamp": datetime.now().isoformat(),
+        "is_from_me": is_from_me,
+        "type": message_type, # e.g., "text", "template", "image"
+        "wamid": wamid,
+        "template": template,
+        "source": source
+    }])
+    if not stored:
+        return None
+    return {
+        "id": stored[0]['id'],
+        "text": message_text,
+        "timestamp": stored[0]['timestamp'],
         "isFromMe": is_from_me,
-        "type": message_type # e.g., "text", "template", "image"
+        "type": message_type
     }
-    all_messages[phone_number].append(new_message)
-    save_messages_to_file(all_messages)
-    log(f"Chat message saved for {phone_number}: {'Me ->' if is_from_me else '-> Me'} {message_text[:50]}...", log_type="INFO")
+
+# --- Delivery Tracking ---
+# Outgoing messages keep their wamid and a one-integer delivery state, so a
+# status callback is one indexed lookup and update. Whenever a message moves
+# forward, the counters of its template and of the funnel, flow or broadcast
+# that sent it are bumped in delivery_stats, so delivery and read rates are
+# read without scanning the message history. Counters are cumulative: a
+# read message also counts as delivered, even if its "delivered" callback
+# never arrives. Statuses only move forward, as callbacks may arrive out of
+# order.
+DELIVERY_STATUSES = ('', 'sent', 'delivered', 'read', 'failed') # messages.status indexes this
+DELIVERY_SENT, DELIVERY_FAILED = 1, 4
+
+def delivery_stat_keys(template, source):
+    return [key for key in (template and f"template:{template}", source) if key]
+
+def count_delivery(conn, keys, old_status, new_status):
+    """Bumps the delivery counters of keys for a message moving from old_status to new_status."""
+    if not keys or new_status <= old_status:
+        return
+    if new_status == DELIVERY_FAILED:
+        columns = ['failed']
+    else:
+        columns = [DELIVERY_STATUSES[status] for status in range(old_status + 1, new_status + 1)]
+    increments = ', '.join(f"{column} = {column} + 1" for column in columns)
+    for key in keys:
+        conn.execute('INSERT INTO delivery_stats (key) VALUES (?) ON CONFLICT (key) DO NOTHING', (key,))
+        conn.execute(f'UPDATE delivery_stats SET {increments} WHERE key = ?', (key,))
+
+def update_delivery_status(conn, wamid, status_name, received_at):
+    """Applies one status callback; returns the updated message's id, or None if the status is unknown or not newer."""
+    status = DELIVERY_STATUSES.index(status_name) if status_name in DELIVERY_STATUSES[1:] else 0
+    if not status or not wamid:
+        return None
+    row = conn.execute(
+        'SELECT id, status, template, source FROM messages WHERE wamid = ? AND is_from_me = 1', (wamid,)
+    ).fetchone()
+    if row is None:
+        # Not stored yet (or not sent by us): keep it for insert_chat_messages
+        conn.execute('''
+            INSERT INTO delivery_orphans (wamid, status, received_at) VALUES (?, ?, ?)
+            ON CONFLICT (wamid) DO UPDATE SET status = MAX(status, excluded.status)
+        ''', (wamid, status, received_at))
+        return None
+    if status <= row['status']:
+        return None
+    conn.execute('UPDATE messages SET status = ? WHERE id = ?', (status, row['id']))
+    count_delivery(conn, delivery_stat_keys(row['template'], row['source']), row['status'], status)
+    return row['id']
+
+def get_delivery_stats():
+    """Returns {"templates": {name: counters}, "funnels": ..., "flows": ..., "broadcasts": ...}."""
+    stats = {"templates": {}, "funnels": {}, "flows": {}, "broadcasts": {}}
+    for row in get_store().execute('SELECT * FROM delivery_stats ORDER BY key'):
+        kind, _, name = row['key'].partition(':')
+        counters = {column: row[column] for column in DELIVERY_STATUSES[1:]}
+        stats.setdefault(f"{kind}s", {})[name] = counters
+    return stats
+
+# --- Inbox Event Stream ---
+# New messages and delivery statuses are pushed to open inboxes over
+# server-sent events (GET /api/events) instead of being polled for.
+# Publishers append to the events table inside the same transaction that
+# stores the message, so every gunicorn worker sees every event: one
+# dispatcher thread per process tails the table and fans new rows out to
+# that process's connected clients. Event ids double as SSE ids, so a
+# client that reconnects with Last-Event-ID gets what it missed. Each open
+# stream holds a worker thread, so gunicorn runs threaded workers (see
+# gunicorn.conf.py); a server without threads answers 503 and the inbox
+# falls back to polling.
+def publish_event(conn, event_type, data):
+    """Records an inbox event inside the caller's transaction."""
+    conn.execute('INSERT INTO events (type, data, created_at) VALUES (?, ?, ?)',
+                 (event_type, json.dumps(data), time.time()))
+
+class EventBus:
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.last_id = None
+
+    def _latest_id(self):
+        # Called with self.lock held; starts from the newest event when the process starts
+        if self.last_id is None:
+            self.last_id = get_store().execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        return self.last_id
+
+    def subscribe(self):
+        """Returns a queue receiving (id, type, data) for every later event, and the id it starts after."""
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.add(subscriber)
+            return subscriber, self._latest_id()
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def notify(self):
+        """Wakes this process's dispatcher after publishing, instead of waiting for the next poll."""
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def dispatch(self):
+        """Hands events published since the last call, by any process, to the subscribers."""
+        with self.lock:
+            last_id = self._latest_id()
+        rows = get_store().execute(
+            'SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?', (last_id, EVENT_QUEUE_SIZE)
+        ).fetchall()
+        if not rows:
+            return False
+        with self.lock:
+            self.last_id = rows[-1]['id']
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if subscriber.qsize() >= EVENT_QUEUE_SIZE:
+                # Too far behind: disconnect it, the browser reconnects and catches up from the table
+                self.unsubscribe(subscriber)
+                subscriber.put(None)
+                continue
+            for row in rows:
+                subscriber.put((row['id'], row['type'], row['data']))
+        return True
+
+    def run(self):
+        last_prune = 0
+        while True:
+            try:
+                if not self.dispatch():
+                    with self.wakeup:
+                        self.wakeup.wait(timeout=EVENT_POLL_INTERVAL)
+                if time.monotonic() - last_prune > 60:
+                    last_prune = time.monotonic()
+                    with get_store() as conn:
+                        conn.execute('DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?', (EVENT_RETENTION,))
+            except sqlite3.Error as e:
+                log(f"❌ Event dispatcher database error: {e}", log_type="ERROR")
+                threading.Event().wait(1.0)
+
+event_bus = EventBus()
+
+def ensure_event_dispatcher():
+    """Starts this process's event dispatcher (again after a fork)."""
+    start_background_thread("event-dispatcher", event_bus.run)
+
+def format_event(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+def stream_events(subscriber, sent_id, last_event_id=None):
+    """
+    Yields a subscriber's events in SSE format. With a last_event_id, events
+    the client missed are replayed from the table first, or a 'reset' event
+    tells it to reload when they have already been pruned.
+    """
+    started = time.monotonic()
+    try:
+        yield "retry: 2000\n\n"
+        if last_event_id is not None and last_event_id < sent_id:
+            conn = get_store()
+            oldest = conn.execute('SELECT MIN(id) FROM events').fetchone()[0]
+            rows = conn.execute(
+                'SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?', (last_event_id, EVENT_QUEUE_SIZE + 1)
+            ).fetchall()
+            if oldest is None or oldest > last_event_id + 1 or len(rows) > EVENT_QUEUE_SIZE:
+                yield format_event(sent_id, 'reset', '{}')
+            else:
+                for row in rows:
+                    yield format_event(row['id'], row['type'], row['data'])
+                if rows:
+                    sent_id = max(sent_id, rows[-1]['id'])
+        while time.monotonic() - started < EVENT_STREAM_MAX_AGE:
+            try:
+                item = subscriber.get(timeout=EVENT_KEEPALIVE)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if item is None:
+                return
+            if item[0] > sent_id:
+                sent_id = item[0]
+                yield format_event(*item)
+    finally:
+        event_bus.unsubscribe(subscriber)
+
+# --- WhatsApp Cloud API Client ---
+# All Graph API calls go through one pooled, keep-alive session per process,
+# with timeouts and retries. Sends are paced per phone number by a token
+# bucket so bursts stay within Meta's throughput limit. The bucket lives in
+# the store's rate_limits table, so the limit holds across all gunicorn
+# workers rather than per process.
+class TokenBucket:
+    def __init__(self, key, rate, capacity=None):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or rate
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until it is due. Callers take tokens in turn and
+        the balance may go negative: a negative balance is the queue of senders
+        ahead, so each acquire is a single short write transaction.
+        """
+        conn = get_store()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (self.key,)).fetchone()
+            now = time.time()
+            tokens = self.capacity if row is None else min(self.capacity, row[0] + max(0, now - row[1]) * self.rate)
+            tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)',
+                         (self.key, tokens, now))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+class GraphClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Graph refused these before acting on them, so even a POST /messages can be resent
+    UNPROCESSED_STATUSES = {429, 503}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD'}
+
+    def __init__(self, base_url, access_token, messages_per_second):
+        self.base_url = base_url.rstrip('/')
+        self.access_token = access_token
+        self.messages_per_second = messages_per_second
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.session = None
+        self.pid = None
+
+    def get_session(self):
+        # Sockets must not be shared with a forked parent, so each process gets its own pool
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=64)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers['Authorization'] = f'Bearer {self.access_token}'
+                    self.session, self.pid = session, os.getpid()
+        return self.session
+
+    def bucket_for(self, phone_number_id):
+        with self.lock:
+            if phone_number_id not in self.buckets:
+                self.buckets[phone_number_id] = TokenBucket(f"messages:{phone_number_id}", self.messages_per_second)
+            return self.buckets[phone_number_id]
+
+    def request(self, method, path, **kwargs):
+        """
+        Calls the Graph API and returns the response, raising requests exceptions on failure.
+        GETs are retried on 429/5xx responses (honouring Retry-After) and failed connections.
+        Other methods (e.g. sending a message) are only retried when the request cannot have
+        been acted on - 429/503 or a connect timeout - so a retry never duplicates a send.
+        """
+        url = path if path.startswith('http') else f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault('timeout', GRAPH_TIMEOUT)
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        retry_statuses = self.RETRY_STATUSES if idempotent else self.UNPROCESSED_STATUSES
+        retry_errors = requests.exceptions.ConnectionError if idempotent else requests.exceptions.ConnectTimeout
+        started, status = time.perf_counter(), 'error'
+        try:
+            for attempt in range(GRAPH_MAX_RETRIES + 1):
+                if attempt:
+                    metrics.inc('graph_api_retries_total', method=method)
+                try:
+                    r = self.get_session().request(method, url, **kwargs)
+                except retry_errors:
+                    if attempt == GRAPH_MAX_RETRIES:
+                        raise
+                    time.sleep(0.5 * 2 ** attempt)
+                    continue
+                status = r.status_code
+                if r.status_code not in retry_statuses or attempt == GRAPH_MAX_RETRIES:
+                    r.raise_for_status()
+                    return r
+                retry_after = r.headers.get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * 2 ** attempt
+                time.sleep(min(delay, GRAPH_MAX_RETRY_AFTER))
+        finally:
+            metrics.observe('graph_api_request_duration_seconds', time.perf_counter() - started, method=method, status=status)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def send_message(self, payload, phone_number_id=None, before_send=None):
+        """
+        Sends a /messages payload from a business phone number and returns the response JSON.
+        before_send is called once the rate limit lets the message go; if it returns False
+        the message is not sent and None is returned.
+        """
+        phone_number_id = phone_number_id or WHATSAPP_PHONE_NUMBER_ID
+        self.bucket_for(phone_number_id).acquire()
+        if before_send is not None and not before_send():
+            return None
+        return self.request('POST', f"{phone_number_id}/messages", json=payload).json()
+
+graph_client = GraphClient(GRAPH_API_BASE, WHATSAPP_ACCESS_TOKEN, GRAPH_MESSAGES_PER_SECOND)
+
+def response_wamid(response):
+    """The WhatsApp message id in a /messages response, if any."""
+    messages = response.get('messages') if isinstance(response, dict) else None
+    return messages[0].get('id') if messages else None
 
 def send_whatsapp_message(to_number, message_body):
     """Sends a plain text message via WhatsApp Cloud API."""
-    url = f"https://graph.facebook.com/v19.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        'Authorization': f'Bearer {WHATSAPP_ACCESS_TOKEN}',
-        'Content-Type': 'application/json'
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": to_number,
@@ -106,82 +1397,206 @@ def send_whatsapp_message(to_number, message_body):
         "text": { "body": message_body }
     }
     try:
-        r = requests.post(url, headers=headers, json=payload)
-        r.raise_for_status()
+        response = graph_client.send_message(payload)
+        metrics.inc('messages_sent_total', type='text')
         log(f"✅ Text message sent to {to_number}: {message_body[:50]}...", log_type="INFO")
-        save_chat_message(to_number, message_body, is_from_me=True, message_type="text") # Save outgoing message
+        save_chat_message(to_number, message_body, is_from_me=True, message_type="text",
+                          wamid=response_wamid(response)) # Save outgoing message
         return True
     except requests.exceptions.RequestException as e:
+        metrics.inc('messages_failed_total', type='text', reason='graph_error')
         log(f"❌ Failed to send text message to {to_number}: {e}", log_type="ERROR")
         return False
 
-def send_whatsapp_template(number, template_name):
-    """Sends a template message via WhatsApp Cloud API."""
-    url = f"https://graph.facebook.com/v19.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        'Authorization': f'Bearer {WHATSAPP_ACCESS_TOKEN}',
-        'Content-Type': 'application/json'
-    }
-    payload = {
+def post_whatsapp_template(number, template_name, language="en_US", before_send=None):
+    """Posts a template message without logging or storing it; raises requests exceptions."""
+    return graph_client.send_message({
         "messaging_product": "whatsapp",
         "to": number,
         "type": "template",
         "template": {
             "name": template_name,
-            "language": { "code": "en_US" }
+            "language": { "code": language }
         }
-    }
+    }, before_send=before_send)
+
+def send_whatsapp_template(number, template_name, language="en_US", source=None, before_send=None):
+    """
+    Sends a template message via WhatsApp Cloud API, after checking it against the template catalog.
+    source ("funnel:<name>", "flow:<name>") is credited with the message's delivery statuses.
+    before_send can veto the send once the rate limit allows it, see GraphClient.send_message.
+    """
+    error = template_catalog.validate(template_name, language)
+    if error:
+        metrics.inc('messages_failed_total', type='template', reason='invalid_template')
+        log(f"❌ Not sending template to {number}: {error}", log_type="ERROR")
+        return False
     try:
-        r = requests.post(url, headers=headers, json=payload)
-        r.raise_for_status()
+        response = post_whatsapp_template(number, template_name, language, before_send=before_send)
+        if response is None:
+            log(f"Template '{template_name}' to {number} was called off before sending", log_type="INFO")
+            return False
+        metrics.inc('messages_sent_total', type='template')
         log(f"✅ Template '{template_name}' sent to {number}", log_type="INFO")
-        save_chat_message(number, f"Template: {template_name}", is_from_me=True, message_type="template") # Save outgoing template
+        save_chat_message(number, f"Template: {template_name}", is_from_me=True, message_type="template",
+                          wamid=response_wamid(response), template=template_name, source=source) # Save outgoing template
+        return True
     except requests.exceptions.RequestException as e:
+        metrics.inc('messages_failed_total', type='template', reason='graph_error')
         log(f"❌ Failed to send template to {number}: {e}", log_type="ERROR")
+        return False
+
+def fetch_whatsapp_templates():
+    """Fetches every message template, following the paging.next cursors; raises requests exceptions."""
+    templates = []
+    r = graph_client.get(f"{WHATSAPP_BUSINESS_ACCOUNT_ID}/message_templates", params={'limit': TEMPLATE_PAGE_SIZE})
+    for _ in range(TEMPLATE_MAX_PAGES):
+        page = r.json()
+        templates.extend(page.get('data', []))
+        next_url = page.get('paging', {}).get('next')
+        if not next_url:
+            break
+        r = graph_client.get(next_url)
+    return templates
+
+# --- Template Catalog ---
+# The template list changes rarely, so it is served from memory and
+# refreshed in the background once older than TEMPLATE_CACHE_TTL
+# (stale-while-revalidate). Every refresh is written to TEMPLATE_CACHE_FILE,
+# and each process reloads that snapshot when its mtime changes, so one
+# worker's fetch serves all of them. Sends are checked against the cached
+# catalog without a network hop.
+class TemplateCatalog:
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.templates = []
+        self.index = {} # name -> {language: status}
+        self.fetched_at = 0.0 # 0 until a catalog has been fetched or loaded
+        self.snapshot_mtime = None
+        self.next_attempt = 0.0
+        self.refreshing_pid = None
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    def set_templates(self, templates, fetched_at):
+        index = {}
+        for template in templates:
+            index.setdefault(template.get('name'), {})[template.get('language')] = template.get('status')
+        with self.lock:
+            self.templates, self.index, self.fetched_at = templates, index, fetched_at
+
+    def load_snapshot(self):
+        """Picks up the snapshot file if this or another process rewrote it."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.snapshot_mtime:
+            return
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            log(f"❌ Could not read template snapshot: {e}", log_type="WARNING")
+            return
+        self.snapshot_mtime = mtime
+        if snapshot.get('fetched_at', 0) > self.fetched_at:
+            self.set_templates(snapshot.get('templates', []), snapshot['fetched_at'])
+
+    def refresh(self):
+        """Fetches the catalog from the Graph API and writes the snapshot; returns False on failure."""
+        self.next_attempt = time.time() + TEMPLATE_REFRESH_INTERVAL
+        try:
+            templates = fetch_whatsapp_templates()
+        except requests.exceptions.RequestException as e:
+            log(f"❌ Failed to fetch templates: {e}", log_type="ERROR")
+            return False
+        fetched_at = time.time()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"fetched_at": fetched_at, "templates": templates}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log(f"❌ Could not write template snapshot: {e}", log_type="WARNING")
+        self.set_templates(templates, fetched_at)
+        log(f"Template catalog refreshed ({len(templates)} templates)", log_type="INFO")
+        return True
+
+    def refresh_in_background(self, force=False):
+        """Starts one refresh thread unless one is running or the last attempt was too recent."""
+        with self.lock:
+            if self.refreshing_pid == os.getpid() or time.time() < self.next_attempt:
+                return
+            self.refreshing_pid = os.getpid()
+
+        def run():
+            try:
+                self.load_snapshot() # Another worker may have refreshed it already
+                if force or self.is_stale():
+                    self.refresh()
+            finally:
+                self.refreshing_pid = None
+        threading.Thread(target=run, name="template-refresh", daemon=True).start()
+
+    def warm(self):
+        """Starts loading the catalog in the background while this process has none (cheap once it has)."""
+        if not self.fetched_at:
+            self.refresh_in_background()
+
+    def get(self):
+        """Returns the cached templates (empty while the first load is running); never blocks on Graph."""
+        self.load_snapshot()
+        if not self.fetched_at or self.is_stale():
+            self.refresh_in_background()
+        return self.templates
+
+    def validate(self, name, language="en_US"):
+        """
+        Returns why a template can't be sent in a language, or None if it can.
+        Never calls the Graph API; while no catalog is cached yet every send is
+        refused, so an unknown template is never let through.
+        """
+        self.load_snapshot()
+        if not self.fetched_at or self.is_stale():
+            self.refresh_in_background()
+        if not self.fetched_at:
+            return "Template catalog is still loading, try again shortly"
+        languages = self.index.get(name)
+        if languages is None:
+            self.refresh_in_background(force=True) # It may have been created since the last refresh
+            return f"Template '{name}' does not exist"
+        if language not in languages:
+            return f"Template '{name}' has no '{language}' translation (available: {', '.join(sorted(languages))})"
+        if languages[language] != 'APPROVED':
+            return f"Template '{name}' ({language}) is {languages[language]}"
+        return None
+
+template_catalog = TemplateCatalog(TEMPLATE_CACHE_FILE, TEMPLATE_CACHE_TTL)
 
 def get_whatsapp_templates():
-    """Fetches the list of approved message templates from WhatsApp Cloud API."""
-    url = f"https://graph.facebook.com/v19.0/{WHATSAPP_BUSINESS_ACCOUNT_ID}/message_templates"
-    headers = {
-        'Authorization': f'Bearer {WHATSAPP_ACCESS_TOKEN}'
-    }
-    try:
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
-        return r.json().get('data', [])
-    except requests.exceptions.RequestException as e:
-        log(f"❌ Failed to fetch templates: {e}", log_type="ERROR")
-        return []
+    """Returns all message templates, served from the template catalog."""
+    return template_catalog.get()
 
-# Yeh functions aapke contacts.db database ko handle karenge
-# Aur JSON format mein data return karenge.
+def ensure_template_catalog():
+    """Loads this process's template catalog in the background, so neither pages nor sends wait for it."""
+    template_catalog.warm()
 
-def get_all_contacts():
-    conn = None
-    contacts_list = []
-    try:
-        conn = sqlite3.connect('contacts.db')
-        conn.row_factory = sqlite3.Row # Allows access by column name
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM contacts ORDER BY name ASC')
-        contacts = cursor.fetchall()
-        for contact in contacts:
-            contacts_list.append(dict(contact)) # Convert row to a dictionary
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-    finally:
-        if conn:
-            conn.close()
-    return contacts_list
+# --- Contacts Database ---
+# Each thread keeps one open connection to contacts.db (WAL mode, with a
+# statement cache so repeated queries skip re-preparing). The schema is
+# created and upgraded by CONTACTS_MIGRATIONS, tracked in PRAGMA user_version.
+_contacts_local = threading.local()
+_contacts_init_lock = threading.Lock()
+_contacts_ready = False
 
-# Yeh function database ko city aur tags ke saath set karega
-def setup_database():
-    conn = sqlite3.connect('contacts.db')
-    cursor = conn.cursor()
-    # Purane table ko delete karein aur naya banayein
-    cursor.execute('DROP TABLE IF EXISTS contacts')
-    cursor.execute('''
-        CREATE TABLE contacts (
+CONTACTS_MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS contacts (
             id INTEGER PRIMARY KEY,
             phone_number TEXT UNIQUE NOT NULL,
             name TEXT,
@@ -190,88 +1605,416 @@ def setup_database():
             tags TEXT,
             notes TEXT
         )
-    ''')
-    conn.commit()
-    conn.close()
-    print("Database setup complete with new fields.")
+        ''',
+    ],
+    [
+        'CREATE INDEX IF NOT EXISTS idx_contacts_name ON contacts (name)',
+        'CREATE INDEX IF NOT EXISTS idx_contacts_city ON contacts (city COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS idx_contacts_tags ON contacts (tags)',
+    ],
+    [
+        # Keyset pagination order for /api/contacts
+        "CREATE INDEX IF NOT EXISTS idx_contacts_sort ON contacts (IFNULL(name, ''), id)",
+        # Full-text index over the searchable fields, kept in sync by triggers
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+            name, phone_number, email, city, notes,
+            content='contacts', content_rowid='id', prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS contacts_fts_insert AFTER INSERT ON contacts BEGIN
+            INSERT INTO contacts_fts (rowid, name, phone_number, email, city, notes)
+            VALUES (new.id, new.name, new.phone_number, new.email, new.city, new.notes);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS contacts_fts_delete AFTER DELETE ON contacts BEGIN
+            INSERT INTO contacts_fts (contacts_fts, rowid, name, phone_number, email, city, notes)
+            VALUES ('delete', old.id, old.name, old.phone_number, old.email, old.city, old.notes);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS contacts_fts_update AFTER UPDATE ON contacts BEGIN
+            INSERT INTO contacts_fts (contacts_fts, rowid, name, phone_number, email, city, notes)
+            VALUES ('delete', old.id, old.name, old.phone_number, old.email, old.city, old.notes);
+            INSERT INTO contacts_fts (rowid, name, phone_number, email, city, notes)
+            VALUES (new.id, new.name, new.phone_number, new.email, new.city, new.notes);
+        END
+        ''',
+        "INSERT INTO contacts_fts (contacts_fts) VALUES ('rebuild')",
+        # One row per (tag, contact) so tag filters are index lookups
+        '''
+        CREATE TABLE IF NOT EXISTS contact_tags (
+            tag TEXT NOT NULL,
+            contact_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, contact_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_contact_tags_contact ON contact_tags (contact_id)',
+        lambda conn: backfill_contact_tags(conn),
+    ],
+]
+
+CONTACT_FIELDS = ('id', 'phone_number', 'name', 'email', 'city', 'tags', 'notes')
+CONTACT_PAGE_SIZE = 100
+IMPORT_BATCH_SIZE = 1000 # Rows upserted per transaction during bulk import
+IMPORT_MAX_ERRORS = 1000 # Row errors listed in an import report (all are counted)
+EXPORT_CHUNK_SIZE = 1000
+
+def get_contacts_db():
+    """Returns this thread's connection to contacts.db, creating it on first use."""
+    conn = getattr(_contacts_local, 'conn', None)
+    if conn is None:
+        conn = connect_db(CONTACTS_DB)
+        try:
+            migrate_contacts_db(conn)
+        except BaseException:
+            conn.close()
+            raise
+        _contacts_local.conn = conn # Only once the schema is up to date
+    return conn
+
+def migrate_contacts_db(conn):
+    """Applies pending CONTACTS_MIGRATIONS once per process; existing data is kept."""
+    global _contacts_ready
+    if _contacts_ready:
+        return
+    with _contacts_init_lock:
+        if _contacts_ready:
+            return
+        apply_migrations(conn, CONTACTS_MIGRATIONS)
+        _contacts_ready = True
+
+def parse_tags(tags):
+    """Splits a comma-separated tags string into normalized (lowercase, trimmed) tags."""
+    return sorted({tag.strip().lower() for tag in (tags or '').split(',') if tag.strip()})
+
+def sync_contact_tags(conn, contact_id, tags):
+    """Replaces a contact's rows in contact_tags, inside the caller's transaction."""
+    conn.execute('DELETE FROM contact_tags WHERE contact_id = ?', (contact_id,))
+    conn.executemany(
+        'INSERT OR IGNORE INTO contact_tags (tag, contact_id) VALUES (?, ?)',
+        [(tag, contact_id) for tag in parse_tags(tags)]
+    )
+
+def backfill_contact_tags(conn):
+    for row in conn.execute("SELECT id, tags FROM contacts WHERE tags IS NOT NULL AND tags != ''").fetchall():
+        sync_contact_tags(conn, row['id'], row['tags'])
+
+def build_fts_query(search):
+    """Turns free text into an FTS5 query matching every word as a prefix."""
+    words = [word.replace('"', '') for word in search.split()]
+    return ' '.join(f'"{word}"*' for word in words if word)
+
+def encode_cursor(*values):
+    """Packs sort-key values into an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """Returns the values packed by encode_cursor, or None for a malformed cursor."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+# Yeh functions aapke contacts.db database ko handle karenge
+# Aur JSON format mein data return karenge.
+
+def contact_filter_sql(city=None, tag=None):
+    """Returns (WHERE clauses, params) selecting contacts by city and tag."""
+    clauses, params = [], []
+    if city:
+        clauses.append('city = ? COLLATE NOCASE')
+        params.append(city)
+    if tag:
+        clauses.append('id IN (SELECT contact_id FROM contact_tags WHERE tag = ?)')
+        params.append(tag.strip().lower())
+    return clauses, params
+
+def search_contacts(search=None, tag=None, city=None, fields=None, cursor=None, limit=CONTACT_PAGE_SIZE):
+    """
+    Returns (contacts, next_cursor) ordered by name.
+    search: words matched as prefixes against name, phone, email, city and notes
+    tag / city: exact filters
+    fields: columns to return (defaults to all)
+    """
+    fields = [field for field in (fields or CONTACT_FIELDS) if field in CONTACT_FIELDS] or list(CONTACT_FIELDS)
+    clauses, params = [], []
+    if search and build_fts_query(search):
+        clauses.append('id IN (SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ?)')
+        params.append(build_fts_query(search))
+    filter_clauses, filter_params = contact_filter_sql(city, tag)
+    clauses += filter_clauses
+    params += filter_params
+    position = decode_cursor(cursor) if cursor else None
+    if position and len(position) == 2:
+        clauses.append("(IFNULL(name, ''), id) > (?, ?)")
+        params += position
+    query = f"SELECT {', '.join(fields)}, IFNULL(name, '') AS sort_name, id AS sort_id FROM contacts"
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += " ORDER BY IFNULL(name, ''), id LIMIT ?"
+    with metrics.timer('store_operation_duration_seconds', operation='search_contacts'):
+        rows = get_contacts_db().execute(query, params + [limit + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['sort_name'], rows[-1]['sort_id'])
+    return [{field: row[field] for field in fields} for row in rows], next_cursor
+
+# Yeh function database ko city aur tags ke saath set karega
+def setup_database():
+    """Creates the contacts schema or upgrades it to the latest version, keeping existing data."""
+    get_contacts_db()
+    print("Database setup complete.")
+
+def contact_phone_lookup(phone_number):
+    """The normalized number plus the raw one, so contacts saved before normalization are still found."""
+    return (normalize_phone_number(phone_number) or phone_number, phone_number)
 
 # Naya contact add karne ka function
 def add_contact(phone_number, name, email=None, city=None, tags=None, notes=None):
+    raw_phone, phone_number = phone_number, normalize_phone_number(phone_number)
+    if phone_number is None:
+        return {"status": "error", "message": f"Invalid phone number: {raw_phone!r}"}
     try:
-        conn = sqlite3.connect('contacts.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO contacts (phone_number, name, email, city, tags, notes)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (phone_number, name, email, city, tags, notes))
-        conn.commit()
+        with get_contacts_db() as conn:
+            cursor = conn.execute('''
+                INSERT INTO contacts (phone_number, name, email, city, tags, notes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (phone_number, name, email, city, tags, notes))
+            sync_contact_tags(conn, cursor.lastrowid, tags)
         return {"status": "success", "message": f"Contact '{name}' added."}
     except sqlite3.IntegrityError:
         return {"status": "error", "message": f"Phone number '{phone_number}' already exists."}
-    finally:
-        if conn:
-            conn.close()
 
 def update_contact(phone_number, new_name=None, new_email=None, new_city=None, new_tags=None, new_notes=None):
-    try:
-        conn = sqlite3.connect('contacts.db')
-        cursor = conn.cursor()
-        updates = []
-        params = []
-        if new_name is not None:
-            updates.append("name = ?")
-            params.append(new_name)
-        if new_email is not None:
-            updates.append("email = ?")
-            params.append(new_email)
-        if new_city is not None:
-            updates.append("city = ?")
-            params.append(new_city)
-        if new_tags is not None:
-            updates.append("tags = ?")
-            params.append(new_tags)
-        if new_notes is not None:
-            updates.append("notes = ?")
-            params.append(new_notes)
-        if not updates:
-            return {"status": "error", "message": "No new data provided for update."}
-        params.append(phone_number)
-        query = f"UPDATE contacts SET {', '.join(updates)} WHERE phone_number = ?"
-        cursor.execute(query, params)
-        conn.commit()
-        if cursor.rowcount > 0:
-            return {"status": "success", "message": f"Contact '{phone_number}' updated."}
-        else:
-            return {"status": "error", "message": f"Contact '{phone_number}' not found."}
-    finally:
-        if conn:
-            conn.close()
+    updates = []
+    params = []
+    if new_name is not None:
+        updates.append("name = ?")
+        params.append(new_name)
+    if new_email is not None:
+        updates.append("email = ?")
+        params.append(new_email)
+    if new_city is not None:
+        updates.append("city = ?")
+        params.append(new_city)
+    if new_tags is not None:
+        updates.append("tags = ?")
+        params.append(new_tags)
+    if new_notes is not None:
+        updates.append("notes = ?")
+        params.append(new_notes)
+    if not updates:
+        return {"status": "error", "message": "No new data provided for update."}
+    lookup = contact_phone_lookup(phone_number)
+    query = f"UPDATE contacts SET {', '.join(updates)} WHERE phone_number IN (?, ?)"
+    with get_contacts_db() as conn:
+        cursor = conn.execute(query, params + list(lookup))
+        if cursor.rowcount > 0 and new_tags is not None:
+            contact_id = conn.execute('SELECT id FROM contacts WHERE phone_number IN (?, ?)', lookup).fetchone()[0]
+            sync_contact_tags(conn, contact_id, new_tags)
+    if cursor.rowcount > 0:
+        return {"status": "success", "message": f"Contact '{phone_number}' updated."}
+    else:
+        return {"status": "error", "message": f"Contact '{phone_number}' not found."}
 
 def delete_contact(phone_number):
-    try:
-        conn = sqlite3.connect('contacts.db')
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM contacts WHERE phone_number = ?", (phone_number,))
-        conn.commit()
-        if cursor.rowcount > 0:
-            return {"status": "success", "message": f"Contact '{phone_number}' deleted."}
+    lookup = contact_phone_lookup(phone_number)
+    with get_contacts_db() as conn:
+        conn.execute(
+            'DELETE FROM contact_tags WHERE contact_id IN (SELECT id FROM contacts WHERE phone_number IN (?, ?))',
+            lookup
+        )
+        cursor = conn.execute("DELETE FROM contacts WHERE phone_number IN (?, ?)", lookup)
+    if cursor.rowcount > 0:
+        return {"status": "success", "message": f"Contact '{phone_number}' deleted."}
+    else:
+        return {"status": "error", "message": f"Contact '{phone_number}' not found."}
+
+# --- Bulk Contact Import / Export ---
+# Imports parse CSV or JSON Lines one row at a time and upsert in batches of
+# IMPORT_BATCH_SIZE, one transaction each; existing contacts keep any field
+# the import leaves empty. Exports page through contacts by id, so neither
+# direction holds the whole table in memory.
+PHONE_COLUMN_ALIASES = ('phone_number', 'phone', 'mobile', 'number')
+INVALID_ENCODING_ERROR = "Not valid UTF-8 (save the file as CSV UTF-8 and retry)"
+
+def normalize_phone_number(raw):
+    """Returns the phone number as international digits only, or None if it is not valid."""
+    digits = re.sub(r'[\s\-().]', '', str(raw or ''))
+    if digits.startswith('+'):
+        digits = digits[1:]
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    return digits if digits.isdigit() and 8 <= len(digits) <= 15 else None
+
+def iter_import_rows(stream, file_format):
+    """
+    Yields (row number, dict or None, error or None) from a binary CSV or JSON Lines stream.
+    Bytes that are not UTF-8 (e.g. a Latin-1 export) reject only the rows they appear in.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row_number, row in enumerate(reader, start=2): # Row 1 is the header
+            if any('\ufffd' in (value or '') for value in row.values() if isinstance(value, str)):
+                yield row_number, None, INVALID_ENCODING_ERROR
+                continue
+            yield row_number, {(key or '').strip().lower(): value for key, value in row.items()}, None
+        return
+    for row_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        if '\ufffd' in line:
+            yield row_number, None, INVALID_ENCODING_ERROR
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield row_number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield row_number, None, "Expected a JSON object"
+            continue
+        yield row_number, {str(key).lower(): value for key, value in row.items()}, None
+
+def clean_import_row(row):
+    """Maps an import row onto contact columns; returns (values, error)."""
+    raw_phone = next((row[key] for key in PHONE_COLUMN_ALIASES if row.get(key)), None)
+    phone_number = normalize_phone_number(raw_phone)
+    if phone_number is None:
+        return None, f"Invalid phone number: {raw_phone!r}"
+    values = [phone_number]
+    for field in ('name', 'email', 'city', 'tags', 'notes'):
+        value = row.get(field)
+        if isinstance(value, list):
+            value = ', '.join(str(item) for item in value)
+        value = str(value).strip() if value is not None else ''
+        values.append(value or None)
+    return values, None
+
+def upsert_contacts(conn, batch):
+    """Inserts or updates a batch of cleaned rows in one transaction."""
+    with conn:
+        conn.executemany('''
+            INSERT INTO contacts (phone_number, name, email, city, tags, notes)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (phone_number) DO UPDATE SET
+                name = COALESCE(excluded.name, contacts.name),
+                email = COALESCE(excluded.email, contacts.email),
+                city = COALESCE(excluded.city, contacts.city),
+                tags = COALESCE(excluded.tags, contacts.tags),
+                notes = COALESCE(excluded.notes, contacts.notes)
+        ''', batch)
+        tagged = {values[0]: values[4] for values in batch if values[4] is not None}
+        if tagged:
+            placeholders = ','.join('?' * len(tagged))
+            for row in conn.execute(
+                f'SELECT id, phone_number FROM contacts WHERE phone_number IN ({placeholders})', list(tagged)
+            ).fetchall():
+                sync_contact_tags(conn, row['id'], tagged[row['phone_number']])
+
+def import_contacts(stream, file_format):
+    """Streams contacts from a CSV/JSONL file into contacts.db and returns a report."""
+    conn = get_contacts_db()
+    report = {"imported": 0, "failed": 0, "errors": []}
+    batch = []
+    for row_number, row, error in iter_import_rows(stream, file_format):
+        values = None
+        if error is None:
+            values, error = clean_import_row(row)
+        if error is not None:
+            report['failed'] += 1
+            if len(report['errors']) < IMPORT_MAX_ERRORS:
+                report['errors'].append({"row": row_number, "error": error})
+            continue
+        batch.append(values)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            upsert_contacts(conn, batch)
+            report['imported'] += len(batch)
+            batch = []
+    if batch:
+        upsert_contacts(conn, batch)
+        report['imported'] += len(batch)
+    log(f"📥 Imported {report['imported']} contacts ({report['failed']} rows rejected)", log_type="INFO")
+    return report
+
+def export_contacts(file_format):
+    """Yields the contacts table as CSV or JSON Lines text, one chunk of rows at a time."""
+    conn = get_contacts_db()
+    last_id = 0
+    if file_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CONTACT_FIELDS[1:])
+    while True:
+        rows = conn.execute(
+            f"SELECT {', '.join(CONTACT_FIELDS)} FROM contacts WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, EXPORT_CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        if file_format == 'csv':
+            writer.writerows([row[field] for field in CONTACT_FIELDS[1:]] for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
         else:
-            return {"status": "error", "message": f"Contact '{phone_number}' not found."}
-    finally:
-        if conn:
-            conn.close()
+            yield ''.join(json.dumps({field: row[field] for field in CONTACT_FIELDS[1:]}, ensure_ascii=False) + '\n' for row in rows)
+    if file_format == 'csv' and buffer.getvalue():
+        yield buffer.getvalue() # Header of an empty table
 
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+def detect_import_format(requested=None, filename=None, content_type=None):
+    """Picks 'csv' or 'jsonl' from an explicit choice, else the file name or content type."""
+    if requested in ('csv', 'jsonl'):
+        return requested
+    if (filename or '').lower().endswith(('.jsonl', '.ndjson', '.json')) or 'json' in (content_type or ''):
+        return 'jsonl'
+    return 'csv'
+
+@app.cli.command('import-contacts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+def import_contacts_command(path, file_format):
+    """Bulk import contacts from a CSV or JSON Lines file."""
+    file_format = detect_import_format(file_format, filename=path)
+    with open(path, 'rb') as f:
+        report = import_contacts(f, file_format)
+    click.echo(f"Imported {report['imported']} contacts, rejected {report['failed']} rows.")
+    for error in report['errors']:
+        click.echo(f"  row {error['row']}: {error['error']}")
+
+@app.cli.command('export-contacts')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default='csv')
+def export_contacts_command(path, file_format):
+    """Export every contact to a CSV or JSON Lines file."""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in export_contacts(file_format):
+            f.write(chunk)
+    click.echo(f"Contacts exported to {path}")
 
 # Ab, yeh API routes `app.py` mein jodein
 
 @app.route('/api/contacts', methods=['GET', 'POST'])
 def handle_contacts():
     if request.method == 'GET':
-        contacts = get_all_contacts()
-        return jsonify(contacts)
+        # ?q= search, ?tag= / ?city= filters, ?fields=name,phone_number, ?limit= and ?cursor= paging
+        fields = request.args.get('fields')
+        contacts, next_cursor = search_contacts(
+            search=request.args.get('q') or None,
+            tag=request.args.get('tag') or None,
+            city=request.args.get('city') or None,
+            fields=fields.split(',') if fields else None,
+            cursor=request.args.get('cursor') or None,
+            limit=parse_limit(CONTACT_PAGE_SIZE)
+        )
+        return jsonify({"contacts": contacts, "next_cursor": next_cursor})
     elif request.method == 'POST':
         data = request.json
         # Yahan humne city aur tags ko bhi add kiya hai
@@ -312,13 +2055,64 @@ def handle_single_contact(phone_number):
         else:
             return jsonify(result), 404
             
+@app.route('/api/contacts/import', methods=['POST'])
+def handle_contacts_import():
+    """
+    Bulk imports contacts from an uploaded file (form field "file") or the raw request body.
+    Format comes from ?format=csv|jsonl, else the file name or content type.
+    """
+    upload = request.files.get('file')
+    if upload:
+        file_format = detect_import_format(request.args.get('format'), upload.filename, upload.content_type)
+        report = import_contacts(upload.stream, file_format)
+    else:
+        file_format = detect_import_format(request.args.get('format'), content_type=request.content_type)
+        report = import_contacts(request.stream, file_format)
+    if report['failed'] and not report['imported']:
+        return jsonify(dict(report, status="error", message="No rows could be imported")), 400
+    return jsonify(dict(report, status="success"))
+
+@app.route('/api/contacts/export', methods=['GET'])
+def handle_contacts_export():
+    """Streams every contact as CSV (default) or JSON Lines (?format=jsonl)."""
+    file_format = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    return Response(
+        export_contacts(file_format),
+        mimetype='application/x-ndjson' if file_format == 'jsonl' else 'text/csv',
+        headers={"Content-Disposition": f"attachment; filename=contacts.{file_format}"}
+    )
+
 # --- Authentication and Routing ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_started,
+                        method=request.method, route=route, status=response.status_code)
+    return response
+
+@app.before_request
+def start_background_workers():
+    """Makes sure this process runs its background workers (cheap after the first request)."""
+    get_store() # Applies pending store migrations (incl. the legacy log) before serving
+    ensure_ingest_workers()
+    ensure_scheduler()
+    ensure_broadcast_runner()
+    ensure_flow_runner()
+    ensure_event_dispatcher()
+    ensure_metrics_flusher()
+    ensure_template_catalog()
+
 @app.before_request
 def check_authentication():
     """
     Checks login status before each request, except for login and static files.
     """
-    if request.path not in ['/login', '/static', '/webhook', '/embeddable-form', '/form-submission'] and 'user' not in session:
+    if request.path not in ['/login', '/static', '/webhook', '/embeddable-form', '/form-submission', '/metrics'] and 'user' not in session:
         return redirect(url_for('login'))
 
 @app.route('/')
@@ -354,6 +2148,20 @@ def logout():
 def dashboard():
     return render_template('dashboard.html', title='Dashboard')
 
+@app.route('/api/dashboard/stats', methods=['GET'])
+def get_dashboard_stats():
+    """Dashboard counters and delivery/read rates, all read from indexes and pre-aggregated tables."""
+    store = get_store()
+    active_since = datetime.fromtimestamp(time.time() - 24 * 60 * 60).isoformat()
+    return jsonify({
+        "contacts": get_contacts_db().execute('SELECT COUNT(*) FROM contacts').fetchone()[0],
+        "conversations": store.execute('SELECT COUNT(*) FROM chats').fetchone()[0],
+        "active_conversations": store.execute('SELECT COUNT(*) FROM chats WHERE timestamp >= ?', (active_since,)).fetchone()[0],
+        "funnels": len(funnel_repository.all()),
+        "flows": store.execute('SELECT COUNT(*) FROM flows').fetchone()[0],
+        "delivery": get_delivery_stats()
+    })
+
 @app.route('/inbox')
 def inbox():
     # This route will now load the inbox HTML, JS will fetch data via API
@@ -362,7 +2170,8 @@ def inbox():
 @app.route('/templates')
 def templates():
     templates_list = get_whatsapp_templates()
-    return render_template('templates.html', title='Templates', templates=templates_list)
+    return render_template('templates.html', title='Templates', templates=templates_list,
+                           loading=not template_catalog.fetched_at)
 
 @app.route('/automation')
 def automation():
@@ -370,33 +2179,101 @@ def automation():
 
 @app.route('/logs')
 def logs():
-    logs_data = []
-    if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
-        try:
-            with open(LOG_FILE, 'r') as f:
-                logs_data = json.load(f)
-        except json.JSONDecodeError:
-            log("❌ log.json file is corrupted. Clearing it.", log_type="ERROR")
-            os.remove(LOG_FILE)
-    
-    return render_template('logs.html', title='System Logs', logs=logs_data)
+    # Entries are loaded page by page from /api/logs
+    return render_template('logs.html', title='System Logs')
+
+@app.route('/api/logs', methods=['GET'])
+def api_get_logs():
+    """
+    Returns one page of log entries, newest first.
+    Filters: ?level=INFO|WARNING|ERROR, ?since= / ?until= (ISO timestamps), ?q= (substring).
+    Pass the returned next_cursor back as ?cursor= to fetch the following page.
+    """
+    level = request.args.get('level')
+    entries, next_cursor = query_logs(
+        level=level if level and level != 'All' else None,
+        since=request.args.get('since') or None,
+        until=request.args.get('until') or None,
+        search=request.args.get('q') or None,
+        cursor=request.args.get('cursor') or None,
+        limit=parse_limit(LOG_PAGE_SIZE)
+    )
+    return jsonify({"logs": entries, "next_cursor": next_cursor})
 
 @app.route('/clear-logs', methods=['POST'])
 def clear_logs():
-    if os.path.exists(LOG_FILE):
-        try:
-            os.remove(LOG_FILE)
-            log("All logs cleared.", log_type="INFO")
-            return jsonify({"status": "success", "message": "Logs cleared"}), 200
-        except OSError as e:
-            log(f"❌ Failed to clear logs: {e}", log_type="ERROR")
-            return jsonify({"status": "error", "message": f"Failed to clear logs: {e}"}), 500
-    return jsonify({"status": "success", "message": "No log file to clear"}), 200
+    try:
+        log_writer.clear()
+        log("All logs cleared.", log_type="INFO")
+        return jsonify({"status": "success", "message": "Logs cleared"}), 200
+    except OSError as e:
+        log(f"❌ Failed to clear logs: {e}", log_type="ERROR")
+        return jsonify({"status": "error", "message": f"Failed to clear logs: {e}"}), 500
+
+# --- Metrics and Profiler Routes ---
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus text exposition of all workers' metrics, see render_metrics.
+    Needs a logged-in session or the METRICS_TOKEN bearer token, unless METRICS_PUBLIC is set.
+    """
+    token_ok = METRICS_TOKEN and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")
+    if not (METRICS_PUBLIC or token_ok or 'user' in session):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiler/start', methods=['POST'])
+def start_profiler():
+    """Starts the sampling profiler in every worker (within METRICS_FLUSH_INTERVAL)."""
+    interval = request.args.get('interval', PROFILER_INTERVAL, type=float)
+    interval = max(0.001, min(interval, 1.0))
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for filename in os.listdir(METRICS_DIR):
+        if filename.endswith('.folded'):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(METRICS_DIR, filename))
+    settings = {"interval": interval, "started_at": time.time()}
+    with open(os.path.join(METRICS_DIR, 'profiler.json'), 'w') as f:
+        json.dump(settings, f)
+    profiler.start(interval, settings['started_at'])
+    log(f"Sampling profiler started (every {interval}s)", log_type="INFO")
+    return jsonify({"status": "success", "message": "Profiler started", "interval": interval})
+
+@app.route('/api/profiler/stop', methods=['POST'])
+def stop_profiler():
+    """
+    Stops the profiler and returns every worker's samples as collapsed stacks
+    (flamegraph.pl / speedscope input). Other workers' samples are at most
+    METRICS_FLUSH_INTERVAL old.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(METRICS_DIR, 'profiler.json'))
+    profiler.stop()
+    dump_profile()
+    stacks = {}
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.folded'):
+            continue
+        with open(os.path.join(METRICS_DIR, filename)) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack and count.isdigit():
+                    stacks[stack] = stacks.get(stack, 0) + int(count)
+    log(f"Sampling profiler stopped ({sum(stacks.values())} samples)", log_type="INFO")
+    body = ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+    return Response(body, mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename=profile-{int(time.time())}.folded'})
 
 # --- Funnel API Routes ---
 @app.route('/funnels', methods=['GET'])
 def get_funnels():
-    return jsonify(funnels)
+    funnel_repository.refresh()
+    return jsonify(funnel_repository.all())
+
+@app.route('/api/funnels/stats', methods=['GET'])
+def get_funnel_stats():
+    """Returns pending/sending/sent/failed step counts per funnel."""
+    return jsonify(get_funnel_step_counts())
 
 @app.route('/save-funnel', methods=['POST'])
 def save_funnel():
@@ -404,9 +2281,21 @@ def save_funnel():
     keyword = data.get('keyword')
     steps = data.get('steps', [])
     if keyword:
-        funnels[keyword.lower()] = steps
-        with open(FUNNEL_FILE, 'w') as f:
-            json.dump(funnels, f, indent=2)
+        # Optional trigger settings, see TriggerMatcher; plain keyword funnels stay a step list
+        spec = steps
+        if data.get('match', 'exact') != 'exact' or data.get('pattern') or data.get('phone_number_id'):
+            spec = {key: data[key] for key in ('match', 'pattern', 'phone_number_id') if data.get(key)}
+            spec['steps'] = steps
+        try:
+            TriggerMatcher.compile_rule(keyword.lower(), spec)
+        except ValueError as e:
+            log(f"❌ Invalid trigger for funnel '{keyword}': {e}", log_type="WARNING")
+            return jsonify({"status": "error", "message": f"Invalid trigger: {e}"}), 400
+        try:
+            funnel_repository.save(keyword.lower(), spec)
+        except OSError as e:
+            log(f"❌ Failed to save funnel '{keyword}': {e}", log_type="ERROR")
+            return jsonify({"status": "error", "message": f"Failed to save funnel: {e}"}), 500
         log(f"✅ Funnel '{keyword}' saved", log_type="INFO")
         return jsonify({"status": "success", "message": "Funnel saved"}), 200
     log("❌ Invalid data for funnel save.", log_type="WARNING")
@@ -415,40 +2304,105 @@ def save_funnel():
 @app.route('/delete-funnel', methods=['DELETE'])
 def delete_funnel():
     keyword = request.args.get('keyword', '').lower()
-    if keyword in funnels:
-        del funnels[keyword]
-        with open(FUNNEL_FILE, 'w') as f:
-            json.dump(funnels, f, indent=2)
+    try:
+        deleted = funnel_repository.delete(keyword)
+    except OSError as e:
+        log(f"❌ Failed to delete funnel '{keyword}': {e}", log_type="ERROR")
+        return jsonify({"status": "error", "message": f"Failed to delete funnel: {e}"}), 500
+    if deleted:
         log(f"🗑️ Funnel '{keyword}' deleted", log_type="INFO")
         return jsonify({"status": "success", "message": "Funnel deleted"}), 200
     log(f"❌ Funnel '{keyword}' not found for deletion.", log_type="WARNING")
     return jsonify({"status": "error", "message": "Funnel not found"}), 404
 
+# --- Flow API Routes ---
+@app.route('/api/flows', methods=['GET'])
+def list_flows():
+    """Lists saved flows with their session counts by status."""
+    counts = get_flow_session_counts()
+    rows = get_store().execute('SELECT name, updated_at FROM flows ORDER BY name').fetchall()
+    return jsonify([{"name": row['name'], "updated_at": datetime.fromtimestamp(row['updated_at']).isoformat(),
+                     "sessions": counts.get(row['name'], {})} for row in rows])
+
+@app.route('/api/flows/<name>', methods=['GET', 'PUT', 'DELETE'])
+def handle_flow(name):
+    if request.method == 'GET':
+        row = get_store().execute('SELECT graph FROM flows WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return jsonify({"status": "error", "message": "Flow not found"}), 404
+        return jsonify({"name": name, "graph": json.loads(row['graph'])})
+
+    if request.method == 'DELETE':
+        if delete_flow(name):
+            log(f"🗑️ Flow '{name}' deleted", log_type="INFO")
+            return jsonify({"status": "success", "message": "Flow deleted"}), 200
+        return jsonify({"status": "error", "message": "Flow not found"}), 404
+
+    try:
+        save_flow(name, request.get_json(silent=True))
+    except ValueError as e:
+        log(f"❌ Invalid flow '{name}': {e}", log_type="WARNING")
+        return jsonify({"status": "error", "message": f"Invalid flow: {e}"}), 400
+    log(f"✅ Flow '{name}' saved", log_type="INFO")
+    return jsonify({"status": "success", "message": "Flow saved"}), 200
+
 # --- New Inbox API Routes ---
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    """Server-sent event stream of new messages and delivery statuses, see stream_events."""
+    if not request.environ.get('wsgi.multithread'):
+        # A stream would pin a single-threaded worker and block /webhook
+        return jsonify({"status": "error", "message": "Event stream needs a threaded server"}), 503
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    subscriber, sent_id = event_bus.subscribe()
+    return Response(stream_events(subscriber, sent_id, last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/chats', methods=['GET'])
 def api_get_chats():
-    """Returns a summary of all chats (last message, contact info)."""
-    all_messages = load_messages()
-    chat_summaries = []
-    for phone_number, messages in all_messages.items():
-        if messages:
-            last_message = messages[-1]
-            chat_summaries.append({
-                "phone_number": phone_number,
-                "last_message": last_message['text'],
-                "timestamp": last_message['timestamp'],
-                "isFromMe": last_message['isFromMe']
-            })
-    # Sort chats by latest message
-    chat_summaries.sort(key=lambda x: x['timestamp'], reverse=True)
-    return jsonify(chat_summaries)
+    """
+    Returns one page of chat summaries (last message per conversation), newest first.
+    Pass the returned next_cursor back as ?cursor= to fetch the following page.
+    """
+    limit = parse_limit(CHAT_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+    with metrics.timer('store_operation_duration_seconds', operation='read_chats'):
+        if cursor:
+            cursor_timestamp, _, cursor_phone = cursor.partition('|')
+            rows = get_store().execute('''
+                SELECT * FROM chats WHERE (timestamp, phone_number) < (?, ?)
+                ORDER BY timestamp DESC, phone_number DESC LIMIT ?
+            ''', (cursor_timestamp, cursor_phone, limit + 1)).fetchall()
+        else:
+            rows = get_store().execute(
+                'SELECT * FROM chats ORDER BY timestamp DESC, phone_number DESC LIMIT ?', (limit + 1,)
+            ).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['timestamp']}|{rows[-1]['phone_number']}"
+    chat_summaries = [{
+        "phone_number": row['phone_number'],
+        "last_message": row['last_message'],
+        "timestamp": row['timestamp'],
+        "isFromMe": bool(row['is_from_me'])
+    } for row in rows]
+    return jsonify({"chats": chat_summaries, "next_cursor": next_cursor})
 
 @app.route('/api/chats/<phone_number>', methods=['GET'])
 def api_get_chat_history(phone_number):
-    """Returns the full message history for a specific phone number."""
-    all_messages = load_messages()
-    messages = all_messages.get(phone_number, [])
-    return jsonify(messages)
+    """
+    Returns one page of message history for a specific phone number.
+    Supports ?before=<id> (older page), ?after=<id> (messages since id) and ?limit=.
+    """
+    messages, has_more = get_chat_messages(
+        phone_number,
+        before=request.args.get('before', type=int),
+        after=request.args.get('after', type=int),
+        limit=parse_limit(HISTORY_PAGE_SIZE)
+    )
+    return jsonify({"messages": messages, "has_more": has_more})
 
 @app.route('/api/send_message', methods=['POST'])
 def api_send_message():
@@ -466,11 +2420,1357 @@ def api_send_message():
     else:
         return jsonify({"status": "error", "message": "Failed to send message"}), 500
     
+# --- Broadcast API Routes ---
+@app.route('/api/broadcasts', methods=['GET', 'POST'])
+def handle_broadcasts():
+    if request.method == 'GET':
+        rows = get_store().execute('SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?', (parse_limit(50),)).fetchall()
+        return jsonify([broadcast_row_to_dict(row) for row in rows])
+    data = request.json or {}
+    template = data.get('template')
+    if not template:
+        return jsonify({"status": "error", "message": "Missing template"}), 400
+    language = data.get('language') or "en_US"
+    error = template_catalog.validate(template, language)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    broadcast_id = create_broadcast(
+        template,
+        language=language,
+        city=data.get('city') or None,
+        tag=data.get('tag') or None
+    )
+    return jsonify({"status": "success", "message": "Broadcast queued", "id": broadcast_id}), 201
+
+@app.route('/api/broadcasts/<int:broadcast_id>', methods=['GET'])
+def get_broadcast(broadcast_id):
+    row = get_store().execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+    if row is None:
+        return jsonify({"status": "error", "message": "Broadcast not found"}), 404
+    return jsonify(broadcast_row_to_dict(row))
+
+@app.route('/api/broadcasts/<int:broadcast_id>/cancel', methods=['POST'])
+def cancel_broadcast(broadcast_id):
+    with get_store() as conn:
+        cursor = conn.execute("""
+            UPDATE broadcasts SET status = 'cancelled', finished_at = ?
+            WHERE id = ? AND status IN ('pending', 'running')
+        """, (datetime.now().isoformat(), broadcast_id))
+    if cursor.rowcount == 0:
+        return jsonify({"status": "error", "message": "Broadcast not found or already finished"}), 404
+    log(f"🛑 Broadcast {broadcast_id} cancelled", log_type="INFO")
+    return jsonify({"status": "success", "message": "Broadcast cancelled"})
+
 @app.route('/embeddable-form')
 def embeddable_form():
     """Renders just the form HTML for embedding via iframe."""
     return render_template('embeddable_form.html')
 
+# --- Funnel Step Scheduler ---
+# Funnel steps are rows in scheduled_steps instead of one threading.Timer
+# each, so they survive restarts and are shared by all gunicorn workers.
+# One dispatcher thread per process claims due steps in due_at order and
+# hands them to a bounded pool of senders; claiming is a single UPDATE, so
+# a step is only ever taken by one process.
+_scheduler_wakeup = threading.Condition()
+_scheduler_pool = None
+_scheduler_slots = threading.BoundedSemaphore(SCHEDULER_CONCURRENCY)
+
+def schedule_funnel_steps(conn, phone_number, funnel, steps):
+    """
+    Queues every step of a funnel for a contact, each `delay` seconds from now.
+    Runs inside the caller's transaction; notify _scheduler_wakeup once it commits.
+    """
+    now = datetime.now()
+    rows = [(now.timestamp() + step.get('delay', 5), phone_number, funnel, step.get('template'), now.isoformat())
+            for step in steps]
+    conn.executemany('''
+        INSERT INTO scheduled_steps (due_at, phone_number, funnel, template, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+
+def claim_due_steps(limit):
+    """Marks up to `limit` due steps as sending for this process and returns them."""
+    conn = get_store()
+    now = datetime.now().timestamp()
+    claim = f"{os.getpid()}:{now}"
+    with conn:
+        # Steps stuck in 'sending' belong to a process that died mid-send
+        conn.execute('''
+            UPDATE scheduled_steps SET status = 'pending'
+            WHERE status = 'sending' AND claimed_at < ?
+        ''', (now - SCHEDULER_CLAIM_TIMEOUT,))
+        conn.execute('''
+            UPDATE scheduled_steps SET status = 'sending', claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM scheduled_steps WHERE status = 'pending' AND due_at <= ? ORDER BY due_at LIMIT ?
+            )
+        ''', (claim, now, now, limit))
+    return conn.execute(
+        "SELECT * FROM scheduled_steps WHERE claimed_by = ? AND status = 'sending'", (claim,)
+    ).fetchall()
+
+def next_step_due_in():
+    """Seconds until the earliest pending step is due (capped at SCHEDULER_POLL_INTERVAL)."""
+    row = get_store().execute("SELECT MIN(due_at) FROM scheduled_steps WHERE status = 'pending'").fetchone()
+    if row[0] is None:
+        return SCHEDULER_POLL_INTERVAL
+    return max(0, min(row[0] - datetime.now().timestamp(), SCHEDULER_POLL_INTERVAL))
+
+def renew_step_claim(step):
+    """Restarts the claim timeout of a step; False once another process has reclaimed it."""
+    with get_store() as conn:
+        cursor = conn.execute('''
+            UPDATE scheduled_steps SET claimed_at = ? WHERE id = ? AND claimed_by = ? AND status = 'sending'
+        ''', (datetime.now().timestamp(), step['id'], step['claimed_by']))
+    return cursor.rowcount > 0
+
+def run_scheduled_step(step):
+    """
+    Sends one claimed step and records the outcome. A step can wait behind the
+    shared rate limit for longer than SCHEDULER_CLAIM_TIMEOUT, so the claim is
+    renewed right before the Graph call; a step reclaimed meanwhile is left to
+    the process that reclaimed it.
+    """
+    started = time.perf_counter()
+    try:
+        if not step['template']:
+            sent, error = False, "Step has no template"
+        else:
+            sent = send_whatsapp_template(step['phone_number'], step['template'], source=f"funnel:{step['funnel']}",
+                                          before_send=lambda: renew_step_claim(step))
+            error = None if sent else "Send failed"
+        owned = (step['id'], step['claimed_by'])
+        with get_store() as conn:
+            if sent:
+                conn.execute('''
+                    UPDATE scheduled_steps SET status = 'sent', last_error = NULL
+                    WHERE id = ? AND claimed_by = ? AND status = 'sending'
+                ''', owned)
+            elif step['template'] and step['attempts'] < SCHEDULER_MAX_ATTEMPTS:
+                conn.execute('''
+                    UPDATE scheduled_steps SET status = 'pending', due_at = ?, last_error = ?
+                    WHERE id = ? AND claimed_by = ? AND status = 'sending'
+                ''', (datetime.now().timestamp() + SCHEDULER_RETRY_DELAY * step['attempts'], error) + owned)
+            else:
+                conn.execute('''
+                    UPDATE scheduled_steps SET status = 'failed', last_error = ?
+                    WHERE id = ? AND claimed_by = ? AND status = 'sending'
+                ''', (error,) + owned)
+    except Exception as e:
+        log(f"❌ Scheduled step {step['id']} crashed: {e}", log_type="ERROR")
+    finally:
+        metrics.observe('dispatch_duration_seconds', time.perf_counter() - started, kind='funnel_step')
+        _scheduler_slots.release()
+
+def dispatch_claimed(slots, concurrency, claim, pool, run):
+    """
+    Waits for a free slot, claims up to as many jobs as there are free slots
+    and hands them to pool; run releases its job's slot when done. Slots left
+    unused, including when claim raises, are released here. Returns the
+    number of jobs claimed.
+    """
+    slots.acquire()
+    free = 1
+    while free < concurrency and slots.acquire(blocking=False):
+        free += 1
+    jobs = []
+    try:
+        jobs = claim(free)
+    finally:
+        for _ in range(free - len(jobs)):
+            slots.release()
+    for job in jobs:
+        pool.submit(run, job)
+    return len(jobs)
+
+def prune_scheduled_steps():
+    """Deletes sent and failed steps that were due more than SCHEDULER_RETENTION ago."""
+    with get_store() as conn:
+        conn.execute('''
+            DELETE FROM scheduled_steps WHERE status IN ('sent', 'failed') AND due_at < ?
+        ''', (datetime.now().timestamp() - SCHEDULER_RETENTION,))
+
+def scheduler_loop():
+    global _scheduler_pool
+    _scheduler_pool = ThreadPoolExecutor(max_workers=SCHEDULER_CONCURRENCY, thread_name_prefix="funnel-send")
+    pruned_at = float('-inf')
+    while True:
+        try:
+            if time.monotonic() - pruned_at >= SCHEDULER_PRUNE_INTERVAL:
+                pruned_at = time.monotonic()
+                prune_scheduled_steps()
+            # Only claim as many steps as there are free senders
+            claimed = dispatch_claimed(_scheduler_slots, SCHEDULER_CONCURRENCY, claim_due_steps,
+                                       _scheduler_pool, run_scheduled_step)
+            if not claimed:
+                wait = next_step_due_in()
+                if wait > 0:
+                    with _scheduler_wakeup:
+                        _scheduler_wakeup.wait(timeout=wait)
+        except sqlite3.Error as e:
+            log(f"❌ Funnel scheduler database error: {e}", log_type="ERROR")
+            threading.Event().wait(1.0)
+
+def ensure_scheduler():
+    """Starts this process's funnel dispatcher (again after a fork)."""
+    start_background_thread("funnel-scheduler", scheduler_loop)
+
+def get_funnel_step_counts():
+    """Returns {funnel: {status: count}} for all scheduled funnel steps."""
+    counts = {}
+    for row in get_store().execute('SELECT funnel, status, COUNT(*) AS n FROM scheduled_steps GROUP BY funnel, status'):
+        counts.setdefault(row['funnel'], {"pending": 0, "sending": 0, "sent": 0, "failed": 0})[row['status']] = row['n']
+    return counts
+
+# --- Funnel Trigger Matching ---
+# All saved funnels are compiled into one TriggerMatcher, so matching an
+# incoming message never loops over the funnels. A funnel is either a plain
+# list of steps (legacy: exact keyword match) or a dict:
+#   {"steps": [...], "match": "exact" | "prefix" | "contains" | "regex",
+#    "pattern": "<regex, for match=regex>", "phone_number_id": "<optional tenant>"}
+# Exact keywords are a dict lookup, prefixes a trie walk, "contains" keywords
+# one Aho-Corasick pass and regexes one combined alternation. Every rule sees
+# the message lowercased with whitespace collapsed (regexes match case-
+# insensitively). Funnels may share a pattern; the alphabetically first of
+# them fires. Saving or deleting a funnel updates only its own rules; the
+# automaton and combined regex of the affected phone number are rebuilt
+# lazily on the next match.
+FUNNEL_MATCH_TYPES = ('exact', 'prefix', 'contains', 'regex')
+
+def funnel_steps(spec):
+    """Returns the step list of a funnel in either storage format."""
+    return spec.get('steps', []) if isinstance(spec, dict) else spec
+
+def normalize_trigger_text(text):
+    return ' '.join((text or '').lower().split())
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton finding whole-word keywords anywhere in a text."""
+    def __init__(self):
+        self.keywords = {} # keyword -> funnel keys using it
+        self.dirty = False
+        self.goto, self.fail, self.output = [{}], [0], [[]]
+
+    def add(self, keyword, funnel_key):
+        if keyword not in self.keywords:
+            self.dirty = True
+        self.keywords.setdefault(keyword, set()).add(funnel_key)
+
+    def remove(self, keyword, funnel_key):
+        funnel_keys = self.keywords.get(keyword, set())
+        funnel_keys.discard(funnel_key)
+        if not funnel_keys and self.keywords.pop(keyword, None) is not None:
+            self.dirty = True
+
+    def build(self):
+        goto, fail, output = [{}], [0], [[]]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                if char not in goto[state]:
+                    goto.append({})
+                    fail.append(0)
+                    output.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            output[state].append(keyword)
+        pending = deque(goto[0].values()) # Breadth-first, so failure targets are finished first
+        while pending:
+            state = pending.popleft()
+            for char, next_state in goto[state].items():
+                pending.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                output[next_state] = output[next_state] + output[fail[next_state]]
+        self.goto, self.fail, self.output = goto, fail, output
+        self.dirty = False
+
+    def search(self, text):
+        """Returns the funnel of the first (then longest) whole-word keyword found in text."""
+        if self.dirty:
+            self.build()
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for keyword in sorted(self.output[state], key=len, reverse=True):
+                start = end - len(keyword) + 1
+                before_ok = start == 0 or not text[start - 1].isalnum()
+                after_ok = end + 1 == len(text) or not text[end + 1].isalnum()
+                if before_ok and after_ok:
+                    return min(self.keywords[keyword])
+        return None
+
+class TenantTriggers:
+    """The compiled rules of one business phone number (or of all numbers)."""
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.prefix_trie = {}
+        self.contains = KeywordAutomaton()
+        self.regexes = {}
+        self.combined_regex = None
+        self.regex_groups = []
+        self.regex_dirty = False
+
+    def add(self, funnel_key, match_type, pattern):
+        if match_type == 'exact':
+            self.exact.setdefault(pattern, set()).add(funnel_key)
+        elif match_type == 'prefix':
+            self.prefixes[funnel_key] = pattern
+            node = self.prefix_trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node.setdefault(None, set()).add(funnel_key)
+        elif match_type == 'contains':
+            self.contains.add(pattern, funnel_key)
+        else:
+            self.regexes[funnel_key] = pattern
+            self.regex_dirty = True
+
+    def remove(self, funnel_key, match_type, pattern):
+        if match_type == 'exact':
+            funnel_keys = self.exact.get(pattern, set())
+            funnel_keys.discard(funnel_key)
+            if not funnel_keys:
+                self.exact.pop(pattern, None)
+        elif match_type == 'prefix':
+            self.prefixes.pop(funnel_key, None)
+            path, node = [], self.prefix_trie
+            for char in pattern:
+                if char not in node:
+                    return
+                path.append((node, char))
+                node = node[char]
+            node.get(None, set()).discard(funnel_key)
+            if node.get(None):
+                return # Still used by another funnel
+            node.pop(None, None)
+            for parent, char in reversed(path): # Prune branches left empty
+                if parent[char]:
+                    break
+                del parent[char]
+        elif match_type == 'contains':
+            self.contains.remove(pattern, funnel_key)
+        else:
+            self.regexes.pop(funnel_key, None)
+            self.regex_dirty = True
+
+    def match(self, text):
+        if text in self.exact:
+            return min(self.exact[text])
+        node, longest = self.prefix_trie, None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            longest = node.get(None, longest)
+        if longest is not None:
+            return min(longest)
+        funnel_key = self.contains.search(text)
+        if funnel_key is not None:
+            return funnel_key
+        if self.regex_dirty:
+            self.regex_groups = sorted(self.regexes)
+            self.combined_regex = re.compile('|'.join(
+                f"(?P<g{i}>{self.regexes[key]})" for i, key in enumerate(self.regex_groups)
+            ), re.IGNORECASE) if self.regex_groups else None
+            self.regex_dirty = False
+        if self.combined_regex is not None:
+            found = self.combined_regex.search(text)
+            if found:
+                return self.regex_groups[int(found.lastgroup[1:])]
+        return None
+
+class TriggerMatcher:
+    def __init__(self):
+        self.tenants = {}
+        self.rules = {} # funnel key -> (tenant, match type, pattern)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def compile_rule(funnel_key, spec):
+        """Returns (tenant, match type, pattern) for a funnel, raising ValueError if invalid."""
+        if not isinstance(spec, dict):
+            return None, 'exact', normalize_trigger_text(funnel_key)
+        match_type = spec.get('match', 'exact')
+        if match_type not in FUNNEL_MATCH_TYPES:
+            raise ValueError(f"Unknown match type '{match_type}'")
+        if match_type == 'regex':
+            pattern = spec.get('pattern') or funnel_key
+            try:
+                # Compiled as it will sit in the combined alternation, so inline global flags are caught
+                compiled = re.compile(f"(?P<g0>{pattern})", re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Invalid regex: {e}")
+            # Patterns are joined into one alternation, where group names and numbers would clash
+            if list(compiled.groupindex) != ['g0'] or re.search(r'\\[1-9]', pattern):
+                raise ValueError("Regex triggers may not use named groups or backreferences")
+        else:
+            pattern = normalize_trigger_text(spec.get('pattern') or funnel_key)
+        return spec.get('phone_number_id') or None, match_type, pattern
+
+    def add(self, funnel_key, spec):
+        """Adds or replaces the trigger of one funnel."""
+        rule = self.compile_rule(funnel_key, spec)
+        with self.lock:
+            self._remove(funnel_key)
+            self.tenants.setdefault(rule[0], TenantTriggers()).add(funnel_key, rule[1], rule[2])
+            self.rules[funnel_key] = rule
+
+    def remove(self, funnel_key):
+        with self.lock:
+            self._remove(funnel_key)
+
+    def _remove(self, funnel_key):
+        rule = self.rules.pop(funnel_key, None)
+        if rule is not None:
+            self.tenants[rule[0]].remove(funnel_key, rule[1], rule[2])
+
+    def match(self, text, phone_number_id=None):
+        """Returns the key of the funnel triggered by a message, or None."""
+        text = normalize_trigger_text(text)
+        with self.lock:
+            for tenant in (phone_number_id, None) if phone_number_id else (None,):
+                if tenant in self.tenants:
+                    funnel_key = self.tenants[tenant].match(text)
+                    if funnel_key is not None:
+                        return funnel_key
+        return None
+
+trigger_matcher = TriggerMatcher()
+
+# --- Funnel Repository ---
+# funnels.json is shared by every gunicorn worker. Writes take an exclusive
+# flock on funnels.json.lock, re-read the file, apply the one change and
+# replace the file atomically (temp file, fsync, rename), so concurrent saves
+# never clobber each other and a crash never leaves a half-written file.
+# Every rename gives the file a new inode, so a worker notices another
+# worker's write with one stat() (at most every FUNNEL_RELOAD_INTERVAL) and
+# only then re-reads it, updating the trigger matcher for just the funnels
+# that changed.
+class FunnelRepository:
+    def __init__(self, path, matcher):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.matcher = matcher
+        self.funnels = {}
+        self.version = None # (inode, mtime, size) of the file self.funnels was read from
+        self.generation = 0 # Bumped whenever self.funnels changes
+        self.checked_at = 0.0
+        self.lock = threading.RLock()
+
+    def file_version(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def read(self):
+        """Reads funnels.json ({} if missing); raises ValueError if it is not valid JSON."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if not isinstance(data, dict):
+            raise ValueError("funnels.json does not hold an object")
+        return data
+
+    def write(self, data):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        """Holds the cross-process write lock (only the in-process lock without fcntl)."""
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def apply(self, data, version):
+        """Swaps in a new funnel dict, updating the matcher for changed funnels only."""
+        with self.lock:
+            for key in self.funnels.keys() - data.keys():
+                self.matcher.remove(key)
+            for key, spec in data.items():
+                if key in self.funnels and self.funnels[key] == spec:
+                    continue
+                try:
+                    self.matcher.add(key, spec)
+                except ValueError as e:
+                    self.matcher.remove(key)
+                    log(f"❌ Skipping funnel '{key}': {e}", log_type="ERROR")
+            if data != self.funnels:
+                self.generation += 1
+            self.funnels, self.version = data, version
+
+    def refresh(self, force=False):
+        """Reloads funnels.json if another process replaced it since it was last read."""
+        now = time.monotonic()
+        if not force and now - self.checked_at < FUNNEL_RELOAD_INTERVAL:
+            return
+        self.checked_at = now
+        version = self.file_version()
+        if version == self.version:
+            return
+        with self.lock:
+            try:
+                data = self.read()
+            except (OSError, ValueError) as e:
+                log(f"❌ Could not load {self.path}: {e}", log_type="ERROR")
+                self.version = version # Retried once the file changes again
+                return
+            self.apply(data, version)
+
+    def update(self, key, spec):
+        """Saves (or with spec None, deletes) one funnel; returns whether it existed before."""
+        with self.file_lock():
+            try:
+                data = self.read()
+            except ValueError as e:
+                raise OSError(f"{self.path} is corrupt, not overwriting it: {e}")
+            existed = key in data
+            if spec is None:
+                if not existed:
+                    self.apply(data, self.file_version())
+                    return False
+                del data[key]
+            else:
+                data[key] = spec
+            self.write(data)
+            self.apply(data, self.file_version())
+        return existed
+
+    def save(self, key, spec):
+        self.update(key, spec)
+
+    def delete(self, key):
+        return self.update(key, None)
+
+    def get(self, key):
+        return self.funnels.get(key)
+
+    def all(self):
+        return dict(self.funnels)
+
+funnel_repository = FunnelRepository(FUNNEL_FILE, trigger_matcher)
+funnel_repository.refresh(force=True)
+
+# --- Flow Engine ---
+# Runs the graph flows built in automation.html (trigger, message,
+# wait_until, conditional_branch and api nodes). Each contact in a flow is a
+# row in flow_sessions holding its current node and a small JSON dict of
+# variables, so thousands of waiting contacts cost nothing but rows. One
+# dispatcher thread per process claims sessions that are due and advances
+# each on a bounded pool until it waits, needs a reply or ends; progress is
+# written back after every node that sends or calls out, so a restart
+# continues where the session stopped.
+# Session status: waiting (run at wake_at), input (parked on a trigger until
+# the contact replies), running (claimed), done, failed or cancelled.
+FLOW_NODE_TYPES = ('trigger', 'message', 'wait_until', 'conditional_branch', 'api')
+FLOW_WAIT_UNITS = {'seconds': 1, 'minutes': 60, 'hours': 60 * 60, 'days': 24 * 60 * 60}
+FLOW_API_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+_flows = {} # name -> (updated_at, compiled flow or None if it no longer compiles)
+_flow_entries = {} # normalized trigger keyword -> [(flow name, trigger node id)]
+_flows_checked_at = 0.0
+_flows_lock = threading.Lock()
+_flow_wakeup = threading.Condition()
+_flow_pool = None
+_flow_slots = threading.BoundedSemaphore(FLOW_CONCURRENCY)
+_flow_http = None
+_flow_http_pid = None
+
+def parse_json_property(value, what):
+    """Returns an API node's headers/body as stored by the editor (object or JSON text)."""
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        try:
+            return json.loads(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON in {what}: {e}")
+    return value
+
+def compile_flow(graph):
+    """
+    Indexes a flow graph by node id with every edge resolved, raising
+    ValueError for unknown node types, missing settings or edges to nodes
+    that do not exist.
+    """
+    steps = graph.get('steps') if isinstance(graph, dict) else None
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Flow has no steps")
+    ids = [step.get('id') if isinstance(step, dict) else None for step in steps]
+    if not all(ids) or len(set(ids)) != len(ids):
+        raise ValueError("Every step needs a unique id")
+
+    nodes, entries = {}, {}
+    for index, step in enumerate(steps):
+        node_id, node_type, props = step['id'], step.get('type'), step.get('properties') or {}
+        if node_type not in FLOW_NODE_TYPES:
+            raise ValueError(f"Step {node_id} has unknown type '{node_type}'")
+        # Same implicit edge the flowchart view draws: on to the next step in the list
+        implicit_next = ids[index + 1] if index + 1 < len(ids) and node_type not in ('trigger', 'conditional_branch') else None
+        node = {'id': node_id, 'type': node_type, 'next': props.get('nextStepId') or implicit_next}
+        targets = [node['next']]
+
+        if node_type == 'trigger':
+            keywords = [k.strip() for k in (props.get('keywords') or '').split(',') if k.strip()]
+            routes = {}
+            for button in props.get('buttons') or []:
+                if button.get('text') and button.get('targetId'):
+                    routes[normalize_trigger_text(button['text'])] = button['targetId']
+            for keyword in keywords:
+                if props.get(f'keyword_{keyword}'):
+                    routes[normalize_trigger_text(keyword)] = props[f'keyword_{keyword}']
+                entries.setdefault(normalize_trigger_text(keyword), node_id)
+            node.update(routes=routes, default=props.get('defaultPathId') or None)
+            targets += list(routes.values()) + [node['default']]
+        elif node_type == 'message':
+            if not props.get('templateId'):
+                raise ValueError(f"Message step {node_id} has no template")
+            node['template'] = props['templateId']
+        elif node_type == 'wait_until':
+            if props.get('waitType') == 'date_time':
+                try:
+                    node['until'] = datetime.fromisoformat(props.get('targetDateTime') or '').timestamp()
+                except ValueError:
+                    raise ValueError(f"Wait step {node_id} has an invalid date/time")
+            else:
+                unit = FLOW_WAIT_UNITS.get(props.get('durationUnit') or 'minutes')
+                try:
+                    node['delay'] = float(props.get('duration')) * unit
+                except (TypeError, ValueError):
+                    raise ValueError(f"Wait step {node_id} has an invalid duration")
+        elif node_type == 'conditional_branch':
+            node['conditions'] = [
+                (c.get('variable') or '', c.get('operator') or 'equals', c.get('value'), c['targetId'])
+                for c in props.get('conditions') or [] if c.get('targetId')
+            ]
+            node['fallback'] = props.get('fallbackId') or None
+            targets += [c[3] for c in node['conditions']] + [node['fallback']]
+        elif node_type == 'api':
+            method = (props.get('method') or 'GET').upper()
+            if method not in FLOW_API_METHODS or not (props.get('url') or '').strip():
+                raise ValueError(f"API step {node_id} needs a method and URL")
+            headers = parse_json_property(props.get('headers'), f"headers of step {node_id}") or {}
+            if not isinstance(headers, dict):
+                raise ValueError(f"Headers of step {node_id} must be a JSON object")
+            node.update(method=method, url=props['url'].strip(), headers=headers,
+                        body=parse_json_property(props.get('body'), f"body of step {node_id}"),
+                        success=props.get('successPathId') or node['next'], fail=props.get('failPathId') or None)
+            targets += [node['success'], node['fail']]
+
+        for target in targets:
+            if target and target not in ids:
+                raise ValueError(f"Step {node_id} points to missing step {target}")
+        nodes[node_id] = node
+    return {'nodes': nodes, 'entries': entries}
+
+def refresh_flows(force=False):
+    """Recompiles flows saved or deleted by any process since the last check."""
+    global _flows, _flow_entries, _flows_checked_at
+    if not force and time.monotonic() - _flows_checked_at < FLOW_RELOAD_INTERVAL:
+        return
+    conn = get_store()
+    with _flows_lock:
+        _flows_checked_at = time.monotonic()
+        versions = {row['name']: row['updated_at'] for row in conn.execute('SELECT name, updated_at FROM flows')}
+        if versions.keys() == _flows.keys() and all(_flows[name][0] == v for name, v in versions.items()):
+            return
+        flows = {name: _flows[name] for name in versions if name in _flows and _flows[name][0] == versions[name]}
+        for name in versions.keys() - flows.keys():
+            row = conn.execute('SELECT graph, updated_at FROM flows WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                continue
+            try:
+                flows[name] = (row['updated_at'], compile_flow(json.loads(row['graph'])))
+            except ValueError as e:
+                log(f"❌ Flow '{name}' could not be loaded: {e}", log_type="ERROR")
+                flows[name] = (row['updated_at'], None)
+        entries = {}
+        for name, (_, flow) in flows.items():
+            for keyword, node_id in (flow['entries'] if flow else {}).items():
+                entries.setdefault(keyword, []).append((name, node_id))
+        _flows, _flow_entries = flows, entries
+
+def get_flow(name):
+    entry = _flows.get(name)
+    return entry[1] if entry else None
+
+def save_flow(name, graph):
+    """Validates and stores a flow graph; raises ValueError if it does not compile."""
+    compile_flow(graph)
+    with get_store() as conn:
+        conn.execute('''
+            INSERT INTO flows (name, graph, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET graph = excluded.graph, updated_at = excluded.updated_at
+        ''', (name, json.dumps(graph), time.time()))
+    refresh_flows(force=True)
+
+def delete_flow(name):
+    """Deletes a flow and cancels its running sessions; returns False if it did not exist."""
+    now = datetime.now().isoformat()
+    with get_store() as conn:
+        if not conn.execute('DELETE FROM flows WHERE name = ?', (name,)).rowcount:
+            return False
+        conn.execute('''
+            UPDATE flow_sessions SET status = 'cancelled', last_error = 'Flow deleted', updated_at = ?
+            WHERE flow = ? AND status IN ('waiting', 'input', 'running')
+        ''', (now, name))
+    refresh_flows(force=True)
+    return True
+
+def get_flow_session_counts():
+    """Returns {flow: {status: count}} for all flow sessions."""
+    counts = {}
+    for row in get_store().execute('SELECT flow, status, COUNT(*) AS n FROM flow_sessions GROUP BY flow, status'):
+        counts.setdefault(row['flow'], {})[row['status']] = row['n']
+    return counts
+
+def contact_variables(phone_number):
+    """Returns the contact fields flows can branch on, or {} for unknown numbers."""
+    row = get_contacts_db().execute(
+        'SELECT name, email, city, tags FROM contacts WHERE phone_number = ?', (phone_number,)
+    ).fetchone()
+    return dict(row) if row else {}
+
+def handle_flow_message(conn, phone_number, text):
+    """
+    Feeds an incoming message to the flows: wakes this contact's sessions that
+    are waiting for a reply and starts every flow whose trigger keywords match.
+    Runs inside the caller's transaction and returns whether any session became
+    due; notify _flow_wakeup once it commits.
+    """
+    now = datetime.now()
+    entries = _flow_entries.get(normalize_trigger_text(text), [])
+    variables = None
+    if entries:
+        variables = json.dumps({"phone_number": phone_number, "message": text, "reply": text,
+                                "contact": contact_variables(phone_number)})
+    woken = conn.execute('''
+        UPDATE flow_sessions SET status = 'waiting', wake_at = ?, updated_at = ?,
+            variables = json_set(variables, '$.message', ?, '$.reply', ?)
+        WHERE phone_number = ? AND status = 'input'
+    ''', (now.timestamp(), now.isoformat(), text, text, phone_number)).rowcount
+    started = 0
+    for flow, node_id in entries:
+        # Ignored while the contact is still in this flow (idx_flow_sessions_active)
+        started += conn.execute('''
+            INSERT OR IGNORE INTO flow_sessions (flow, phone_number, node, variables, wake_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (flow, phone_number, node_id, variables, now.timestamp(), now.isoformat(), now.isoformat())).rowcount
+    if woken or started:
+        log(f"⚡ Flows: {started} started and {woken} resumed for {phone_number}", log_type="INFO")
+    return bool(woken or started)
+
+def resolve_flow_variable(variables, path):
+    """Looks up a dotted path such as 'contact.city' or 'api.body.items.0.id'."""
+    value = variables
+    for part in path.strip().split('.'):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return None
+    return value
+
+def render_flow_value(value, variables):
+    """Replaces {{path}} placeholders in the strings of an API node's URL, headers or body."""
+    if isinstance(value, str):
+        def substitute(m):
+            resolved = resolve_flow_variable(variables, m.group(1))
+            return '' if resolved is None else str(resolved)
+        return re.sub(r'\{\{\s*([\w.]+)\s*\}\}', substitute, value)
+    if isinstance(value, dict):
+        return {k: render_flow_value(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [render_flow_value(v, variables) for v in value]
+    return value
+
+def evaluate_condition(variables, variable, operator, expected):
+    value = resolve_flow_variable(variables, variable)
+    if operator in ('greater_than', 'less_than'):
+        try:
+            value, expected = float(value), float(expected)
+        except (TypeError, ValueError):
+            return False
+        return value > expected if operator == 'greater_than' else value < expected
+    value = '' if value is None else str(value).strip().lower()
+    expected = '' if expected is None else str(expected).strip().lower()
+    if operator == 'equals':
+        return value == expected
+    if operator == 'not_equals':
+        return value != expected
+    if operator == 'contains':
+        return expected in value
+    return False
+
+def get_flow_http():
+    """Pooled keep-alive session for API nodes (one per process, like the Graph client)."""
+    global _flow_http, _flow_http_pid
+    if _flow_http_pid != os.getpid():
+        with _flows_lock:
+            if _flow_http_pid != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=FLOW_CONCURRENCY)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _flow_http, _flow_http_pid = session, os.getpid()
+    return _flow_http
+
+def call_flow_api(node, variables):
+    """Calls an API node's endpoint; returns (succeeded, {"status": ..., "body": ...})."""
+    kwargs = {'headers': render_flow_value(node['headers'], variables), 'timeout': FLOW_API_TIMEOUT}
+    body = render_flow_value(node['body'], variables)
+    if body is not None and node['method'] != 'GET':
+        kwargs['data' if isinstance(body, str) else 'json'] = body
+    try:
+        # Streamed, so an oversized response is never downloaded past FLOW_API_MAX_BODY
+        with get_flow_http().request(node['method'], render_flow_value(node['url'], variables),
+                                     stream=True, **kwargs) as r:
+            content = r.raw.read(FLOW_API_MAX_BODY + 1, decode_content=True)
+    except requests.exceptions.RequestException as e:
+        return False, {"status": None, "error": str(e)[:200]}
+    except urllib3.exceptions.HTTPError as e:
+        return False, {"status": r.status_code, "error": str(e)[:200]}
+    result = {"status": r.status_code, "body": None}
+    if len(content) <= FLOW_API_MAX_BODY:
+        text = content.decode(r.encoding or 'utf-8', errors='replace')
+        try:
+            result['body'] = json.loads(text)
+        except ValueError:
+            result['body'] = text
+    return r.ok, result
+
+def claim_flow_sessions(limit):
+    """Marks up to `limit` due sessions as running for this process and returns them."""
+    conn = get_store()
+    now = datetime.now().timestamp()
+    claim = f"{os.getpid()}:{now}"
+    with conn:
+        # Sessions stuck in 'running' belong to a process that died mid-run
+        conn.execute('''
+            UPDATE flow_sessions SET status = 'waiting'
+            WHERE status = 'running' AND claimed_at < ?
+        ''', (now - FLOW_CLAIM_TIMEOUT,))
+        conn.execute('''
+            UPDATE flow_sessions SET status = 'running', claimed_by = ?, claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM flow_sessions WHERE status = 'waiting' AND wake_at <= ? ORDER BY wake_at LIMIT ?
+            )
+        ''', (claim, now, now, limit))
+    return conn.execute(
+        "SELECT * FROM flow_sessions WHERE claimed_by = ? AND status = 'running'", (claim,)
+    ).fetchall()
+
+def next_flow_due_in():
+    """Seconds until the earliest waiting session is due (capped at SCHEDULER_POLL_INTERVAL)."""
+    row = get_store().execute("SELECT MIN(wake_at) FROM flow_sessions WHERE status = 'waiting'").fetchone()
+    if row[0] is None:
+        return SCHEDULER_POLL_INTERVAL
+    return max(0, min(row[0] - datetime.now().timestamp(), SCHEDULER_POLL_INTERVAL))
+
+def checkpoint_flow_session(session, node_id, variables, status='running', wake_at=None, attempts=0, error=None):
+    """Writes a session's progress, unless its claim has been taken over by another process."""
+    now = datetime.now()
+    with get_store() as conn:
+        conn.execute('''
+            UPDATE flow_sessions SET node = ?, variables = ?, status = ?, wake_at = ?, attempts = ?,
+                last_error = ?, claimed_at = ?, updated_at = ?
+            WHERE id = ? AND claimed_by = ?
+        ''', (node_id, json.dumps(variables, separators=(',', ':')), status, wake_at or now.timestamp(), attempts,
+              error, now.timestamp(), now.isoformat(), session['id'], session['claimed_by']))
+
+def advance_flow_session(session):
+    """Runs one claimed session until it waits for time or a reply, ends or fails."""
+    phone_number, node_id, attempts = session['phone_number'], session['node'], session['attempts']
+    started = time.perf_counter()
+    try:
+        variables = json.loads(session['variables'])
+        for _ in range(FLOW_MAX_STEPS):
+            flow = get_flow(session['flow'])
+            node = flow['nodes'].get(node_id) if flow else None
+            if node is None:
+                error = "Flow no longer exists" if flow is None else f"Step {node_id} no longer exists"
+                checkpoint_flow_session(session, node_id, variables, status='failed', error=error)
+                return
+            node_type, next_id = node['type'], node['next']
+
+            if node_type == 'trigger':
+                reply = variables.pop('reply', None)
+                next_id = None
+                if reply is not None:
+                    next_id = node['routes'].get(normalize_trigger_text(reply)) or node['default']
+                if next_id is None:
+                    checkpoint_flow_session(session, node_id, variables, status='input')
+                    return
+            elif node_type == 'message':
+                if not send_whatsapp_template(phone_number, node['template'], source=f"flow:{session['flow']}"):
+                    attempts += 1
+                    if attempts < SCHEDULER_MAX_ATTEMPTS:
+                        checkpoint_flow_session(session, node_id, variables, status='waiting', attempts=attempts,
+                                                wake_at=datetime.now().timestamp() + SCHEDULER_RETRY_DELAY * attempts,
+                                                error="Send failed")
+                    else:
+                        checkpoint_flow_session(session, node_id, variables, status='failed', attempts=attempts,
+                                                error="Send failed")
+                    return
+                attempts = 0
+                if next_id:
+                    checkpoint_flow_session(session, next_id, variables)
+            elif node_type == 'wait_until':
+                wake_at = node['until'] if 'until' in node else datetime.now().timestamp() + node['delay']
+                if next_id and wake_at > datetime.now().timestamp():
+                    checkpoint_flow_session(session, next_id, variables, status='waiting', wake_at=wake_at)
+                    return
+            elif node_type == 'conditional_branch':
+                next_id = next((target for variable, operator, expected, target in node['conditions']
+                                if evaluate_condition(variables, variable, operator, expected)), node['fallback'])
+            elif node_type == 'api':
+                succeeded, variables['api'] = call_flow_api(node, variables)
+                next_id = node['success'] if succeeded else node['fail']
+                if next_id is None and not succeeded:
+                    checkpoint_flow_session(session, node_id, variables, status='failed',
+                                            error=f"API call failed ({variables['api'].get('status') or variables['api'].get('error')})")
+                    return
+                if next_id:
+                    checkpoint_flow_session(session, next_id, variables)
+
+            if next_id is None:
+                checkpoint_flow_session(session, node_id, variables, status='done')
+                return
+            node_id = next_id
+        checkpoint_flow_session(session, node_id, variables, status='failed',
+                                error=f"More than {FLOW_MAX_STEPS} steps without waiting")
+    except Exception as e:
+        log(f"❌ Flow session {session['id']} crashed: {e}", log_type="ERROR")
+        try:
+            checkpoint_flow_session(session, node_id, json.loads(session['variables']), status='failed', error=str(e)[:200])
+        except Exception:
+            pass
+    finally:
+        metrics.observe('dispatch_duration_seconds', time.perf_counter() - started, kind='flow_session')
+        _flow_slots.release()
+
+def flow_loop():
+    global _flow_pool
+    _flow_pool = ThreadPoolExecutor(max_workers=FLOW_CONCURRENCY, thread_name_prefix="flow-run")
+    while True:
+        try:
+            refresh_flows()
+            # Only claim as many sessions as there are free runners
+            claimed = dispatch_claimed(_flow_slots, FLOW_CONCURRENCY, claim_flow_sessions,
+                                       _flow_pool, advance_flow_session)
+            if not claimed:
+                wait = next_flow_due_in()
+                if wait > 0:
+                    with _flow_wakeup:
+                        _flow_wakeup.wait(timeout=wait)
+        except sqlite3.Error as e:
+            log(f"❌ Flow engine database error: {e}", log_type="ERROR")
+            threading.Event().wait(1.0)
+
+def ensure_flow_runner():
+    """Starts this process's flow dispatcher (again after a fork)."""
+    start_background_thread("flow-engine", flow_loop)
+
+# --- Broadcasts ---
+# A broadcast sends one template to every contact matching a city/tag filter.
+# Recipients are streamed from contacts.db in id order, BROADCAST_CHUNK_SIZE
+# at a time, and sent in parallel (paced by the Graph client's token bucket).
+# After each chunk the results, the outgoing chat messages and the
+# last_contact_id checkpoint are written in one transaction, so a crashed
+# broadcast resumes where it stopped. Each process runs at most one broadcast.
+BROADCAST_FIELDS = ('id', 'template', 'language', 'city', 'tag', 'status', 'total', 'sent', 'failed',
+                    'created_at', 'finished_at')
+
+def create_broadcast(template, language="en_US", city=None, tag=None):
+    """Queues a broadcast and returns its id."""
+    clauses, params = contact_filter_sql(city, tag)
+    total = get_contacts_db().execute(
+        'SELECT COUNT(*) FROM contacts' + (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+    ).fetchone()[0]
+    with get_store() as store:
+        cursor = store.execute('''
+            INSERT INTO broadcasts (template, language, city, tag, total, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (template, language, city, tag, total, datetime.now().isoformat()))
+    log(f"📣 Broadcast {cursor.lastrowid} of '{template}' queued for {total} contacts", log_type="INFO")
+    return cursor.lastrowid
+
+def claim_broadcast(claim):
+    """Takes the oldest broadcast that is pending or whose runner stopped sending heartbeats."""
+    now = datetime.now().timestamp()
+    with get_store() as conn:
+        conn.execute('''
+            UPDATE broadcasts SET status = 'running', claimed_by = ?, heartbeat_at = ?
+            WHERE id = (
+                SELECT id FROM broadcasts
+                WHERE status = 'pending' OR (status = 'running' AND heartbeat_at < ?)
+                ORDER BY id LIMIT 1
+            )
+        ''', (claim, now, now - BROADCAST_CLAIM_TIMEOUT))
+    return get_store().execute(
+        "SELECT * FROM broadcasts WHERE claimed_by = ? AND status = 'running'", (claim,)
+    ).fetchone()
+
+def stream_broadcast_recipients(broadcast):
+    """Yields chunks of (contact id, phone number) after the broadcast's checkpoint."""
+    clauses, params = contact_filter_sql(broadcast['city'], broadcast['tag'])
+    query = 'SELECT id, phone_number FROM contacts WHERE ' + ' AND '.join(['id > ?'] + clauses) + ' ORDER BY id LIMIT ?'
+    last_id = broadcast['last_contact_id']
+    conn = get_contacts_db()
+    while True:
+        chunk = conn.execute(query, [last_id] + params + [BROADCAST_CHUNK_SIZE]).fetchall()
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        yield chunk
+
+def send_broadcast_message(template, language, phone_number):
+    """Sends one broadcast message and returns (phone number, wamid, error or None)."""
+    try:
+        response = post_whatsapp_template(phone_number, template, language)
+        metrics.inc('messages_sent_total', type='broadcast')
+        return phone_number, response_wamid(response), None
+    except requests.exceptions.RequestException as e:
+        metrics.inc('messages_failed_total', type='broadcast', reason='graph_error')
+        return phone_number, None, str(e)
+
+def renew_broadcast_claim(broadcast_id, claim):
+    """Refreshes the heartbeat; False once the broadcast was cancelled or taken over."""
+    with get_store() as conn:
+        cursor = conn.execute('''
+            UPDATE broadcasts SET heartbeat_at = ? WHERE id = ? AND claimed_by = ? AND status = 'running'
+        ''', (datetime.now().timestamp(), broadcast_id, claim))
+    return cursor.rowcount > 0
+
+def wait_for_broadcast_sends(futures, broadcast_id, claim):
+    """
+    Waits for a chunk's sends while renewing the claim, so a chunk slowed down by
+    the Graph API is not resumed (and re-sent) by another process. When the
+    claim is lost, sends that have not started are cancelled. Returns the
+    results of the sends that ran and whether the claim is still held.
+    """
+    held, pending = True, set(futures)
+    while pending:
+        _, pending = wait_for_futures(pending, timeout=BROADCAST_HEARTBEAT_INTERVAL)
+        if pending and held and not renew_broadcast_claim(broadcast_id, claim):
+            held = False
+            for future in pending:
+                future.cancel()
+    return [future.result() for future in futures if not future.cancelled()], held
+
+def run_broadcast(broadcast, claim, pool):
+    """Sends a claimed broadcast chunk by chunk, checkpointing after each one."""
+    broadcast_id, template, language = broadcast['id'], broadcast['template'], broadcast['language']
+    store = get_store()
+    for chunk in stream_broadcast_recipients(broadcast):
+        # A resumed chunk may contain recipients that were already sent before a crash
+        placeholders = ','.join('?' * len(chunk))
+        done = {row[0] for row in store.execute(
+            f'SELECT phone_number FROM broadcast_recipients WHERE broadcast_id = ? AND phone_number IN ({placeholders})',
+            [broadcast_id] + [phone for _, phone in chunk]
+        )}
+        phones = [phone for _, phone in chunk if phone not in done]
+        with metrics.timer('dispatch_duration_seconds', kind='broadcast_chunk'):
+            futures = [pool.submit(send_broadcast_message, template, language, phone) for phone in phones]
+            results, held = wait_for_broadcast_sends(futures, broadcast_id, claim)
+        now = datetime.now().isoformat()
+        sent = [(phone, wamid) for phone, wamid, error in results if error is None]
+        with store:
+            insert_chat_messages(store, [{
+                "phone_number": phone,
+                "text": f"Template: {template}",
+                "is_from_me": True,
+                "type": "template",
+                "wamid": wamid,
+                "template": template,
+                "source": f"broadcast:{broadcast_id}"
+            } for phone, wamid in sent])
+            store.executemany('''
+                INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, phone_number, status, error, sent_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(broadcast_id, phone, 'sent' if error is None else 'failed', error, now) for phone, _, error in results])
+            if held:
+                cursor = store.execute('''
+                    UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, last_contact_id = ?, heartbeat_at = ?
+                    WHERE id = ? AND claimed_by = ? AND status = 'running'
+                ''', (len(sent), len(results) - len(sent), chunk[-1][0], datetime.now().timestamp(), broadcast_id, claim))
+                held = cursor.rowcount > 0
+            if not held:
+                # Record what did go out; whoever resumes skips these recipients
+                store.execute('UPDATE broadcasts SET sent = sent + ?, failed = failed + ? WHERE id = ?',
+                              (len(sent), len(results) - len(sent), broadcast_id))
+        if not held:
+            log(f"Broadcast {broadcast_id} was cancelled or taken over, stopping.", log_type="WARNING")
+            return
+    with store:
+        store.execute(
+            "UPDATE broadcasts SET status = 'completed', finished_at = ? WHERE id = ? AND claimed_by = ?",
+            (datetime.now().isoformat(), broadcast_id, claim)
+        )
+    log(f"📣 Broadcast {broadcast_id} of '{template}' completed", log_type="INFO")
+
+def broadcast_loop():
+    pool = ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix="broadcast-send")
+    while True:
+        try:
+            claim = f"{os.getpid()}:{datetime.now().timestamp()}"
+            broadcast = claim_broadcast(claim)
+            if broadcast is None:
+                time.sleep(1.0)
+                continue
+            log(f"📣 Running broadcast {broadcast['id']} from contact id {broadcast['last_contact_id']}", log_type="INFO")
+            run_broadcast(broadcast, claim, pool)
+        except sqlite3.Error as e:
+            log(f"❌ Broadcast runner database error: {e}", log_type="ERROR")
+            time.sleep(1.0)
+
+def ensure_broadcast_runner():
+    """Starts this process's broadcast runner (again after a fork)."""
+    start_background_thread("broadcast", broadcast_loop)
+
+def broadcast_row_to_dict(row):
+    return {field: row[field] for field in BROADCAST_FIELDS}
+
+# --- Webhook Ingest Queue ---
+# The webhook POST handler only appends the raw body to webhook_queue and
+# returns, so Meta gets its 200 immediately. A pool of worker threads in
+# each process claims queued payloads one at a time and processes them.
+# Redelivered messages are dropped by the unique index on messages.wamid.
+_ingest_wakeup = threading.Condition()
+_ingest_maintained_at = float('-inf')
+
+def enqueue_webhook(payload):
+    """Durably queues a raw webhook body for the ingest workers."""
+    with get_store() as conn:
+        conn.execute(
+            'INSERT INTO webhook_queue (payload, received_at) VALUES (?, ?)',
+            (payload, datetime.now().isoformat())
+        )
+    with _ingest_wakeup:
+        _ingest_wakeup.notify()
+
+def claim_webhook(worker_name):
+    """Marks the oldest pending payload as taken by this worker and returns it (or None)."""
+    conn = get_store()
+    if conn.execute("SELECT 1 FROM webhook_queue WHERE status = 'pending' LIMIT 1").fetchone() is None:
+        return None # Idle workers only read, they don't queue up for the write lock
+    claim = f"{worker_name}:{datetime.now().timestamp()}"
+    with conn:
+        conn.execute('''
+            UPDATE webhook_queue SET status = 'processing', claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+            WHERE id = (SELECT id FROM webhook_queue WHERE status = 'pending' ORDER BY id LIMIT 1)
+        ''', (claim, datetime.now().timestamp()))
+    return conn.execute(
+        "SELECT * FROM webhook_queue WHERE claimed_by = ? AND status = 'processing'", (claim,)
+    ).fetchone()
+
+def release_stale_webhooks():
+    """
+    Puts payloads claimed by workers that died mid-processing back in the queue
+    and deletes failed payloads older than INGEST_FAILED_RETENTION.
+    """
+    with get_store() as conn:
+        conn.execute('''
+            UPDATE webhook_queue SET status = 'pending'
+            WHERE status = 'processing' AND claimed_at < ?
+        ''', (datetime.now().timestamp() - INGEST_CLAIM_TIMEOUT,))
+        cutoff = datetime.fromtimestamp(time.time() - INGEST_FAILED_RETENTION).isoformat()
+        conn.execute("DELETE FROM webhook_queue WHERE status = 'failed' AND received_at < ?", (cutoff,))
+
+def process_claimed_webhook(row):
+    """Processes one claimed payload, then deletes it, puts it back for a retry or marks it failed."""
+    try:
+        process_webhook_payload(json.loads(row['payload']))
+        with get_store() as conn:
+            conn.execute('DELETE FROM webhook_queue WHERE id = ?', (row['id'],))
+        metrics.inc('webhook_payloads_processed_total', outcome='done')
+    except (ValueError, IndexError, KeyError, AttributeError) as e:
+        metrics.inc('webhook_payloads_processed_total', outcome='malformed')
+        # Malformed payload, retrying will not help
+        with get_store() as conn:
+            conn.execute(
+                "UPDATE webhook_queue SET status = 'failed', last_error = ? WHERE id = ?",
+                (str(e), row['id'])
+            )
+        log(f"❌ Webhook payload processing failed: {e}. Full data: {row['payload']}", log_type="ERROR")
+    except Exception as e:
+        status = 'failed' if row['attempts'] >= INGEST_MAX_ATTEMPTS else 'pending'
+        metrics.inc('webhook_payloads_processed_total', outcome='failed' if status == 'failed' else 'retry')
+        with get_store() as conn:
+            conn.execute(
+                'UPDATE webhook_queue SET status = ?, last_error = ? WHERE id = ?',
+                (status, str(e), row['id'])
+            )
+        log(f"❌ Webhook payload {row['id']} failed (attempt {row['attempts']}): {e}. Full data: {row['payload']}", log_type="ERROR")
+
+def ingest_worker():
+    global _ingest_maintained_at
+    worker_name = f"{os.getpid()}-{threading.current_thread().name}"
+    idle_wait = 0.5
+    while True:
+        try:
+            if time.monotonic() - _ingest_maintained_at >= INGEST_MAINTENANCE_INTERVAL:
+                _ingest_maintained_at = time.monotonic()
+                release_stale_webhooks()
+            row = claim_webhook(worker_name)
+            if row is None:
+                # Webhooks received by this process wake the worker at once; the
+                # backoff only delays work queued by other processes
+                with _ingest_wakeup:
+                    woken = _ingest_wakeup.wait(timeout=idle_wait)
+                idle_wait = 0.5 if woken else min(idle_wait * 2, INGEST_IDLE_MAX_WAIT)
+                continue
+            idle_wait = 0.5
+            process_claimed_webhook(row)
+        except sqlite3.Error as e:
+            log(f"❌ Ingest worker database error: {e}", log_type="ERROR")
+            threading.Event().wait(1.0)
+
+def ensure_ingest_workers():
+    """Starts INGEST_WORKERS threads in this process (again after a fork)."""
+    start_background_thread("ingest", ingest_worker, count=INGEST_WORKERS)
+
+MEDIA_MESSAGE_TYPES = ('image', 'video', 'audio', 'document', 'sticker')
+
+def describe_incoming_message(msg):
+    """
+    Returns the text to show in the inbox for an incoming message, and whether
+    that text was typed or tapped by the customer (and so may trigger a funnel).
+    """
+    message_type = msg.get('type')
+    if message_type == 'text':
+        return msg.get('text', {}).get('body', ''), True
+    if message_type == 'button':
+        return msg.get('button', {}).get('text', ''), True
+    if message_type == 'interactive':
+        interactive = msg.get('interactive', {})
+        reply = interactive.get('button_reply') or interactive.get('list_reply') or {}
+        return reply.get('title', ''), True
+    if message_type in MEDIA_MESSAGE_TYPES:
+        media = msg.get(message_type, {})
+        caption = media.get('caption') or media.get('filename')
+        label = f" ({message_type.capitalize()} received) "
+        return f"{label}{caption}" if caption else label, False
+    if message_type == 'location':
+        location = msg.get('location', {})
+        details = location.get('name') or location.get('address') or f"{location.get('latitude')}, {location.get('longitude')}"
+        return f" (Location received) {details}", False
+    if message_type == 'reaction':
+        return f" (Reaction) {msg.get('reaction', {}).get('emoji', '')}", False
+    return f" ({message_type} received) ", False
+
+def process_statuses(statuses):
+    """Handles delivery status callbacks (sent, delivered, read, failed), see update_delivery_status."""
+    now = time.time()
+    with get_store() as conn:
+        conn.execute('DELETE FROM delivery_orphans WHERE received_at < ?', (now - DELIVERY_ORPHAN_TTL,))
+        for status in statuses:
+            log(f"Status '{status.get('status')}' for message {status.get('id')} to {status.get('recipient_id')}", log_type="INFO")
+            if status.get('status') == 'failed':
+                log(f"❌ Message {status.get('id')} to {status.get('recipient_id')} failed: {json.dumps(status.get('errors', []))}", log_type="WARNING")
+            message_id = update_delivery_status(conn, status.get('id'), status.get('status'), now)
+            publish_event(conn, 'status', {
+                "message_id": str(message_id) if message_id else None, # Set when the stored status advanced
+                "wamid": status.get('id'),
+                "status": status.get('status'),
+                "phone_number": status.get('recipient_id'),
+                "timestamp": status.get('timestamp')
+            })
+    event_bus.notify()
+
+def schedule_message_triggers(conn, stored):
+    """
+    Schedules the funnel steps and flow sessions the newly stored incoming
+    messages trigger, inside the transaction that stored them. Returns the
+    wakeups to send once that transaction commits.
+    """
+    wakeups = set()
+    for item in stored:
+        from_number, message_text = item['phone_number'], item['text']
+        log(f"Incoming {item['type']} message from {from_number}: {message_text[:50]}...", log_type="INFO")
+        if not item['can_trigger']:
+            continue
+
+        # Funnel trigger logic
+        funnel_key = trigger_matcher.match(message_text, item['business_number'])
+        spec = funnel_repository.get(funnel_key) if funnel_key is not None else None
+        if spec is not None:
+            steps = funnel_steps(spec)
+            schedule_funnel_steps(conn, from_number, funnel_key, steps)
+            wakeups.add(_scheduler_wakeup)
+            log(f"⚡ Trigger '{funnel_key}' matched. Scheduled {len(steps)} steps for {from_number}", log_type="INFO")
+        if handle_flow_message(conn, from_number, message_text):
+            wakeups.add(_flow_wakeup)
+    return wakeups
+
+def process_webhook_payload(data):
+    """
+    Stores every incoming message of a webhook payload, together with the
+    funnel steps and flow sessions they trigger, in one transaction; a payload
+    retried after a crash therefore neither loses nor repeats its triggers.
+    Then handles the payload's status callbacks.
+    """
+    log(f"Received webhook: {json.dumps(data)}", log_type="INFO") # Log full webhook for debugging
+    batch, statuses = [], []
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            value = change.get('value', {})
+            business_number = value.get('metadata', {}).get('phone_number_id')
+            statuses.extend(value.get('statuses', []))
+            for msg in value.get('messages', []):
+                if 'from' not in msg or 'type' not in msg:
+                    log(f"❌ Skipping malformed message in webhook: {json.dumps(msg)}", log_type="WARNING")
+                    continue
+                message_text, can_trigger = describe_incoming_message(msg)
+                batch.append({
+                    "phone_number": msg['from'],
+                    "text": message_text,
+                    "is_from_me": False,
+                    "type": msg['type'],
+                    "wamid": msg.get('id'),
+                    "can_trigger": can_trigger,
+                    "business_number": business_number
+                })
+
+    wakeups = set()
+    def schedule_triggers(conn, items):
+        wakeups.update(schedule_message_triggers(conn, items))
+
+    if batch:
+        funnel_repository.refresh() # Picks up funnels and flows saved by other workers
+        refresh_flows()
+    stored = save_chat_messages(batch, schedule_triggers) if batch else []
+    for wakeup in wakeups:
+        with wakeup:
+            wakeup.notify()
+    metrics.inc('messages_received_total', len(stored))
+    if len(stored) < len(batch):
+        log(f"Ignored {len(batch) - len(stored)} duplicate message(s) in webhook.", log_type="INFO")
+    if statuses:
+        process_statuses(statuses)
+
 # --- Webhook for Incoming Messages ---
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
@@ -487,56 +3787,23 @@ def webhook():
             log("❌ Webhook verification failed.", log_type="ERROR")
             return "Verification token mismatch", 403
 
-    # --- Receive & Process Messages (POST Request) ---
-    data = request.json
-    log(f"Received webhook: {json.dumps(data)}", log_type="INFO") # Log full webhook for debugging
-    try:
-        entry = data.get('entry', [])[0]
-        changes = entry.get('changes', [])[0]
-        value = changes.get('value', {})
-        messages = value.get('messages', [])
-        
-        if messages:
-            msg = messages[0]
-            from_number = msg['from']
-            
-            # Handle different message types (text, image, etc.)
-            if msg['type'] == 'text':
-                message_text = msg['text']['body']
-                save_chat_message(from_number, message_text, is_from_me=False, message_type="text")
-                log(f"Incoming text message from {from_number}: {message_text[:50]}...", log_type="INFO")
-
-                # Funnel trigger logic
-                if message_text.strip().lower() in funnels:
-                    steps = funnels[message_text.strip().lower()]
-                    for step in steps:
-                        delay = step.get('delay', 5)
-                        template_name = step.get('template')
-                        threading.Timer(delay, send_whatsapp_template, args=(from_number, template_name)).start()
-                    log(f"⚡ Trigger '{message_text.strip().lower()}' matched. Scheduled {len(steps)} steps for {from_number}", log_type="INFO")
-            elif msg['type'] == 'image':
-                # You might want to save image URL or handle it differently
-                save_chat_message(from_number, " (Image received) ", is_from_me=False, message_type="image")
-                log(f"Incoming image message from {from_number}", log_type="INFO")
-            # Add more message types as needed (video, audio, document etc.)
-            
-    except (IndexError, KeyError) as e:
-        log(f"❌ Webhook payload processing failed: {e}. Full data: {json.dumps(data)}", log_type="ERROR")
-    except Exception as e:
-        log(f"❌ An unexpected error occurred in webhook: {e}. Full data: {json.dumps(data)}", log_type="ERROR")
-    
+    # --- Receive Messages (POST Request) ---
+    # Processing happens on the ingest workers, see process_webhook_payload
+    payload = request.get_data(as_text=True)
+    if not payload:
+        return 'EMPTY_PAYLOAD', 400
+    enqueue_webhook(payload)
+    metrics.inc('webhooks_received_total')
     return 'EVENT_RECEIVED', 200
 
 # ✅ Sudhara gaya: ab sirf ek hi block hai
 # ✅ Sudhara gaya: ab sirf ek hi block hai
 if __name__ == '__main__':
-    # Create the database table
+    # Create or upgrade the contacts table (existing contacts are kept)
     setup_database()
 
-    # Ensure messages.json exists or is created as an empty dict
-    if not os.path.exists(MESSAGES_FILE):
-        with open(MESSAGES_FILE, 'w') as f:
-            json.dump({}, f)
+    # Create the message store and import messages.json on first run
+    get_store()
 
     # Render port binding
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,494 @@
+# bench.py - Benchmark and load test for the WhatsApp tool backend
+#
+# Seeds a throw-away data directory with synthetic conversations, messages
+# and contacts, answers Graph API calls from a local stub server, then drives
+# the main routes and hot functions of app.py in-process. For every benchmark
+# it reports p50/p90/p99 latency, throughput and peak RSS, and can write the
+# results as JSON to compare two commits:
+#
+#   python bench.py --preset small --output before.json
+#   (check out the other commit)
+#   python bench.py --preset small --output after.json --compare before.json
+#
+# --payloads replays recorded webhook bodies (JSON Lines, one payload per
+# line, or records with the payload under "body"/"payload") instead of
+# synthetic text messages.
+#
+# Data is seeded in the formats every version of app.py reads (messages.json
+# and the original contacts table) and driven through the HTTP routes and
+# the long-standing log/save_chat_message functions, so the same harness
+# runs against older commits; benchmarks a commit lacks are skipped.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+try:
+    import resource
+except ImportError: # Windows: peak RSS is not reported
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GRAPH_URL = "https://graph.facebook.com"
+
+PRESETS = {
+    "small": {"conversations": 1000, "messages": 50_000, "contacts": 10_000, "requests": 500},
+    "full": {"conversations": 10_000, "messages": 1_000_000, "contacts": 100_000, "requests": 2000},
+}
+SEED_BATCH_SIZE = 50_000
+CITIES = ['Delhi', 'Mumbai', 'Pune', 'Jaipur', 'Chennai', 'Kolkata', 'Lucknow', 'Surat']
+TAGS = ['lead', 'customer', 'vip', 'newsletter', 'churned', 'wholesale', 'retail']
+WORDS = ['hello', 'price', 'order', 'delivery', 'thanks', 'please', 'status', 'refund', 'catalog', 'offer',
+         'today', 'tomorrow', 'size', 'colour', 'payment', 'invoice', 'address', 'support', 'yes', 'no']
+BENCHMARKS = ('webhook_post', 'webhook_ingest', 'api_chats', 'api_chats_paged', 'api_chat_history',
+              'save_chat_message', 'log', 'api_logs', 'api_contacts_search', 'api_contacts_tag',
+              'api_contacts_add', 'api_send_message')
+
+
+# --- Graph API Stub ---
+class GraphStubHandler(BaseHTTPRequestHandler):
+    """Answers /messages sends and /message_templates lookups like graph.facebook.com."""
+    counter = itertools.count(1)
+    latency = 0.0
+
+    def reply(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        self.reply({
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": payload.get('to'), "wa_id": payload.get('to')}],
+            "messages": [{"id": f"wamid.bench{next(self.counter)}"}]
+        })
+
+    def do_GET(self):
+        self.reply({"data": [
+            {"name": name, "language": "en_US", "status": "APPROVED", "category": "MARKETING", "components": []}
+            for name in ('welcome', 'promo', 'follow_up')
+        ]})
+
+    def log_message(self, *args):
+        pass
+
+def start_graph_stub(latency):
+    GraphStubHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GraphStubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="graph-stub", daemon=True).start()
+    return server
+
+def route_graph_to_stub(stub_url):
+    """Sends requests for graph.facebook.com to the stub, also from versions that hard-code the URL."""
+    send = requests.adapters.HTTPAdapter.send
+
+    def send_to_stub(adapter, request, *args, **kwargs):
+        if request.url.startswith(GRAPH_URL):
+            request.url = stub_url + request.url[len(GRAPH_URL):]
+        return send(adapter, request, *args, **kwargs)
+    requests.adapters.HTTPAdapter.send = send_to_stub
+
+
+# --- Seeding ---
+def phone_for(index):
+    return f"91{9000000000 + index}"
+
+def random_text(rng, words=6):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, words)))
+
+def seed_messages(conversations, messages, rng):
+    """Writes `messages` messages spread over `conversations` chats to messages.json."""
+    chats = {}
+    start = datetime.now() - timedelta(days=90)
+    step = timedelta(days=90) / max(messages, 1)
+    for i in range(messages):
+        chat = chats.setdefault(phone_for(rng.randrange(conversations)), [])
+        chat.append({"id": str(len(chat) + 1), "text": random_text(rng), "timestamp": (start + step * i).isoformat(),
+                     "isFromMe": rng.random() < 0.4, "type": "text"})
+    with open('messages.json', 'w') as f:
+        json.dump(chats, f)
+
+def seed_contacts(contacts, rng):
+    """Writes `contacts` contacts to contacts.db in its original schema and returns their names."""
+    conn = sqlite3.connect('contacts.db')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY,
+            phone_number TEXT UNIQUE NOT NULL,
+            name TEXT,
+            email TEXT,
+            city TEXT,
+            tags TEXT,
+            notes TEXT
+        )
+    ''')
+    names = []
+    for offset in range(0, contacts, SEED_BATCH_SIZE):
+        batch = []
+        for i in range(offset, min(offset + SEED_BATCH_SIZE, contacts)):
+            name = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))).capitalize()
+            names.append(name)
+            batch.append((phone_for(i), name, f"{name.lower()}{i}@example.com", rng.choice(CITIES),
+                          ', '.join(rng.sample(TAGS, rng.randint(1, 3))), None))
+        with conn:
+            conn.executemany(
+                'INSERT INTO contacts (phone_number, name, email, city, tags, notes) VALUES (?, ?, ?, ?, ?, ?)', batch
+            )
+    conn.close()
+    return names
+
+
+# --- Webhook Payloads ---
+def synthetic_payload(rng, conversations, index):
+    return {"object": "whatsapp_business_account", "entry": [{"id": "bench-waba", "changes": [{"field": "messages", "value": {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": "bench-phone"},
+        "contacts": [{"profile": {"name": "Bench"}, "wa_id": phone_for(index % conversations)}],
+        "messages": [{
+            "from": phone_for(rng.randrange(conversations)),
+            "id": f"wamid.in{index}.{rng.random()}",
+            "timestamp": str(int(time.time())),
+            "type": "text",
+            "text": {"body": random_text(rng)}
+        }]
+    }}]}]}
+
+def load_payloads(path):
+    """Reads recorded webhook payloads from a JSON Lines file."""
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for key in ('body', 'payload'):
+                if isinstance(record, dict) and 'entry' not in record and key in record:
+                    record = record[key]
+                    if isinstance(record, str):
+                        try:
+                            record = json.loads(record)
+                        except ValueError:
+                            record = None
+            if isinstance(record, dict) and 'entry' in record:
+                payloads.append(record)
+    return payloads
+
+def replayed_payload(payloads, index):
+    """A recorded payload with its message ids made unique, so replays are not dropped as duplicates."""
+    payload = json.loads(json.dumps(payloads[index % len(payloads)]))
+    for entry in payload.get('entry', []):
+        for change in entry.get('changes', []):
+            for msg in change.get('value', {}).get('messages', []):
+                msg['id'] = f"{msg.get('id', 'wamid')}.replay{index}"
+    return payload
+
+
+# --- Measurement ---
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(func, count, concurrency):
+    """Calls func(i) for i in range(count) from `concurrency` threads; returns latency and throughput stats."""
+    latencies = [0.0] * count
+    errors = []
+    counter = itertools.count()
+
+    def worker():
+        while True:
+            i = next(counter)
+            if i >= count:
+                return
+            started = time.perf_counter()
+            try:
+                ok = func(i)
+            except Exception:
+                ok = False
+            latencies[i] = time.perf_counter() - started
+            if not ok:
+                errors.append(i)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "requests": count,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p90_ms": ms(percentile(latencies, 0.90)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "throughput_rps": round(count / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def has_route(app, path, method='GET'):
+    try:
+        app.app.url_map.bind('localhost').match(path, method=method)
+        return True
+    except Exception: # NotFound / MethodNotAllowed
+        return False
+
+class Clients(threading.local):
+    """One logged-in Flask test client per benchmark thread."""
+    def __init__(self, app):
+        self.client = app.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user'] = 'admin'
+
+
+# --- Benchmarks ---
+def wait_for_ingest(app, timeout):
+    """Blocks until the webhook queue has no pending or processing payloads; returns False on timeout."""
+    if not hasattr(app, 'enqueue_webhook'):
+        return True # Webhooks are processed inside the request
+    deadline = time.monotonic() + timeout
+    conn = app.get_store()
+    while time.monotonic() < deadline:
+        busy = conn.execute("SELECT COUNT(*) FROM webhook_queue WHERE status IN ('pending', 'processing')").fetchone()[0]
+        if not busy:
+            return True
+        time.sleep(0.05)
+    return False
+
+def run_benchmarks(app, args, selected, rng, names):
+    clients = Clients(app)
+    payloads = load_payloads(args.payloads) if args.payloads else None
+    make_payload = (lambda i: replayed_payload(payloads, i)) if payloads else \
+        (lambda i: synthetic_payload(rng, args.conversations, i))
+    n, c = args.requests, args.concurrency
+    phones = [phone_for(rng.randrange(args.conversations)) for _ in range(n)]
+    results = {}
+    skipped = []
+
+    def run(name, func, count=n, concurrency=c, supported=True):
+        if name not in selected:
+            return
+        if not supported:
+            skipped.append(name)
+            print(f"  {name} ... skipped (not in this version)")
+            return
+        print(f"  {name} ...", end='', flush=True)
+        results[name] = measure(func, count, concurrency)
+        print(f" p50 {results[name]['p50_ms']} ms, p99 {results[name]['p99_ms']} ms, "
+              f"{results[name]['throughput_rps']} req/s, errors {results[name]['errors']}")
+
+    def get_ok(url):
+        return clients.client.get(url).status_code == 200
+
+    # Webhook: the request path only enqueues; ingest is measured end to end after it
+    bodies = [json.dumps(make_payload(i)) for i in range(n)]
+    run('webhook_post', lambda i: clients.client.post('/webhook', data=bodies[i], content_type='application/json').status_code == 200)
+    if 'webhook_ingest' in selected and not hasattr(app, 'enqueue_webhook'):
+        run('webhook_ingest', None, supported=False)
+    elif 'webhook_ingest' in selected:
+        wait_for_ingest(app, args.timeout)
+        bodies = [json.dumps(make_payload(n + i)) for i in range(n)]
+        started = time.perf_counter()
+        for body in bodies:
+            app.enqueue_webhook(body)
+        drained = wait_for_ingest(app, args.timeout)
+        elapsed = time.perf_counter() - started
+        results['webhook_ingest'] = {
+            "requests": n, "concurrency": app.INGEST_WORKERS, "errors": 0 if drained else n,
+            "p50_ms": None, "p90_ms": None, "p99_ms": None, "max_ms": None,
+            "throughput_rps": round(n / elapsed, 1), "peak_rss_mb": peak_rss_mb(),
+        }
+        print(f"  webhook_ingest ... {results['webhook_ingest']['throughput_rps']} payloads/s"
+              f"{'' if drained else ' (timed out)'}")
+
+    run('api_chats', lambda i: get_ok('/api/chats'))
+    if 'api_chats_paged' in selected:
+        cursors, cursor = [], None
+        for _ in range(min(n, 200)):
+            data = clients.client.get('/api/chats' + (f'?cursor={cursor}' if cursor else '')).get_json()
+            cursor = data.get('next_cursor') if isinstance(data, dict) else None # Older versions return a list
+            if not cursor:
+                break
+            cursors.append(cursor)
+        run('api_chats_paged', lambda i: get_ok(f'/api/chats?cursor={cursors[i % len(cursors)]}'), supported=bool(cursors))
+    run('api_chat_history', lambda i: get_ok(f'/api/chats/{phones[i]}'))
+    run('save_chat_message', lambda i: app.save_chat_message(phones[i], random_text(rng), i % 2 == 0) or True)
+    run('log', lambda i: app.log(f"Benchmark log entry {i}") is None)
+    run('api_logs', lambda i: get_ok('/api/logs'), supported=has_route(app, '/api/logs'))
+
+    names = rng.sample(names, min(len(names), 100)) or ['bench']
+    run('api_contacts_search', lambda i: get_ok(f'/api/contacts?q={names[i % len(names)][:4]}'))
+    run('api_contacts_tag', lambda i: get_ok(f'/api/contacts?tag={TAGS[i % len(TAGS)]}'))
+    run('api_contacts_add', lambda i: clients.client.post('/api/contacts', json={
+        "phone_number": phone_for(args.contacts + i), "name": f"Bench {i}", "city": rng.choice(CITIES), "tags": "lead"
+    }).status_code == 201)
+    run('api_send_message', lambda i: clients.client.post('/api/send_message', json={
+        "to_number": phones[i], "message_body": random_text(rng)
+    }).status_code == 200)
+    return results, skipped
+
+
+# --- Reporting ---
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    """Prints p50/p99/throughput changes against an earlier JSON report."""
+    with open(baseline_path) as f:
+        baseline = json.load(f).get('results', {})
+    print(f"\nCompared with {baseline_path}:")
+    print(f"  {'benchmark':<22}{'p50 ms':>28}{'p99 ms':>28}{'req/s':>30}")
+    for name, new in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        cells = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_rps'):
+            if old.get(key) is None or new.get(key) is None:
+                cells.append('-')
+                continue
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0
+            cells.append(f"{old[key]} -> {new[key]} ({change:+.0f}%)")
+        print(f"  {name:<22}{cells[0]:>28}{cells[1]:>28}{cells[2]:>30}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WhatsApp tool backend against synthetic data.")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--conversations', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--contacts', type=int)
+    parser.add_argument('--requests', type=int, help="Calls per benchmark")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--only', help=f"Comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--payloads', help="JSON Lines file of recorded webhook payloads to replay")
+    parser.add_argument('--graph-latency', type=float, default=0.0, help="Seconds the Graph API stub waits per call")
+    parser.add_argument('--data-dir', help="Directory for the benchmark databases (default: a new temp dir)")
+    parser.add_argument('--keep', action='store_true', help="Keep the data directory afterwards")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds to wait for the ingest queue to drain")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="Earlier JSON results to compare against")
+    args = parser.parse_args()
+    for key, value in PRESETS[args.preset].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    selected = set(args.only.split(',')) if args.only else set(BENCHMARKS)
+    unknown = selected - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmark(s): {', '.join(sorted(unknown))}")
+    rng = random.Random(args.seed)
+    output, baseline = [os.path.abspath(path) if path else None for path in (args.output, args.compare)]
+    if args.payloads:
+        args.payloads = os.path.abspath(args.payloads)
+
+    # app.py keeps its databases and logs in the working directory and reads its
+    # Graph settings at import, so both are set up before importing it
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='wts-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    stub = start_graph_stub(args.graph_latency)
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+    route_graph_to_stub(stub_url)
+    os.environ.update({
+        "GRAPH_API_BASE": f"{stub_url}/v19.0",
+        "WHATSAPP_ACCESS_TOKEN": "bench-token",
+        "WHATSAPP_PHONE_NUMBER_ID": "bench-phone",
+        "WHATSAPP_BUSINESS_ACCOUNT_ID": "bench-waba",
+        "GRAPH_MESSAGES_PER_SECOND": "1000000",
+    })
+    os.chdir(data_dir)
+
+    print(f"Seeding {args.conversations} conversations, {args.messages} messages and "
+          f"{args.contacts} contacts in {data_dir}")
+    started = time.perf_counter()
+    seed_messages(args.conversations, args.messages, rng)
+    messages_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    names = seed_contacts(args.contacts, rng)
+    contacts_seconds = time.perf_counter() - started
+
+    sys.path.insert(0, REPO_DIR)
+    started = time.perf_counter()
+    import app
+    # The first requests import or migrate the seeded files in versions that keep their own stores
+    warm_up = Clients(app).client
+    warm_up.get('/api/chats')
+    warm_up.get('/api/contacts?limit=1')
+    startup_seconds = time.perf_counter() - started
+    print(f"  messages {messages_seconds:.1f} s, contacts {contacts_seconds:.1f} s, "
+          f"app start-up {startup_seconds:.1f} s, peak RSS {peak_rss_mb()} MB")
+
+    results, skipped = run_benchmarks(app, args, selected, rng, names)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "preset": args.preset,
+            "conversations": args.conversations,
+            "messages": args.messages,
+            "contacts": args.contacts,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "payloads": args.payloads,
+            "graph_latency": args.graph_latency,
+            "seed_seconds": {"messages": round(messages_seconds, 2), "contacts": round(contacts_seconds, 2)},
+            "startup_seconds": round(startup_seconds, 2),
+            "skipped": skipped,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+    if baseline:
+        compare(results, baseline)
+
+    if hasattr(app, 'log_writer'):
+        app.log_writer.flush()
+    if not args.keep and not args.data_dir:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
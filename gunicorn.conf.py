@@ -0,0 +1,13 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app` from the project directory.
+# Each open inbox holds a request thread on /api/events for up to
+# EVENT_STREAM_MAX_AGE, so workers must be threaded: with the default sync
+# worker a single inbox tab would block /webhook.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 32)) # Event streams plus regular requests, per worker
+timeout = 60
+graceful_timeout = 30
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# app.py creates its stores, logs and funnels.json in the working directory
+# on import, so the tests run it inside a throw-away directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="wts-api-tests-"))
+
+STORE_TABLES = ('messages', 'chats', 'webhook_queue', 'scheduled_steps', 'broadcasts', 'broadcast_recipients',
+                'flows', 'flow_sessions', 'events', 'delivery_stats', 'delivery_orphans', 'rate_limits')
+
+
+@pytest.fixture
+def store():
+    """The app's message store, emptied. Tests drive the queues by hand: no background workers run."""
+    import app
+    conn = app.get_store()
+    with conn:
+        for table in STORE_TABLES:
+            conn.execute(f'DELETE FROM {table}')
+    return conn
+
+
+@pytest.fixture
+def contacts():
+    """contacts.db, emptied."""
+    import app
+    conn = app.get_contacts_db()
+    with conn:
+        conn.execute('DELETE FROM contact_tags')
+        conn.execute('DELETE FROM contacts')
+    return conn
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Stubs the Graph API: every template is known and /messages calls are
+    recorded as (to, template) instead of sent. Rate limiting and
+    GraphClient.send_message's before_send hook still run.
+    """
+    import app
+    calls = []
+
+    class Response:
+        def __init__(self, wamid):
+            self.wamid = wamid
+
+        def json(self):
+            return {"messages": [{"id": self.wamid}]}
+
+    def request(method, path, **kwargs):
+        payload = kwargs['json']
+        calls.append((payload['to'], payload.get('template', {}).get('name')))
+        return Response(f"wamid.test.{len(calls)}.{time.time()}")
+
+    monkeypatch.setattr(app.graph_client, 'request', request)
+    monkeypatch.setattr(app.template_catalog, 'validate', lambda name, language="en_US": None)
+    return calls
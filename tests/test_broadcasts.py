@@ -0,0 +1,99 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def broadcast(store, contacts, sent, monkeypatch):
+    """A queued broadcast to seven contacts, sent in chunks of three."""
+    monkeypatch.setattr(app, 'BROADCAST_CHUNK_SIZE', 3)
+    for i in range(7):
+        app.add_contact(f'9100000000{i}', f'Contact {i}')
+    return app.create_broadcast('promo')
+
+
+@pytest.fixture
+def pool():
+    pool = ThreadPoolExecutor(max_workers=1) # One send at a time keeps the crash point deterministic
+    yield pool
+    pool.shutdown()
+
+
+def phones():
+    return [row[0] for row in app.get_contacts_db().execute('SELECT phone_number FROM contacts ORDER BY id')]
+
+
+def contact_id(phone):
+    return app.get_contacts_db().execute('SELECT id FROM contacts WHERE phone_number = ?', (phone,)).fetchone()[0]
+
+
+def row(store, broadcast_id):
+    return store.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+
+
+def test_broadcast_sends_every_chunk(store, broadcast, sent, pool):
+    claimed = app.claim_broadcast('runner')
+    app.run_broadcast(claimed, 'runner', pool)
+    assert [to for to, _ in sent] == phones()
+    done = row(store, broadcast)
+    assert (done['status'], done['sent'], done['failed']) == ('completed', 7, 0)
+    assert store.execute('SELECT COUNT(*) FROM messages WHERE source = ?', (f'broadcast:{broadcast}',)).fetchone()[0] == 7
+
+
+def test_crashed_broadcast_resumes_from_its_checkpoint(store, broadcast, sent, pool, monkeypatch):
+    send = app.graph_client.request
+
+    def dies_in_second_chunk(method, path, **kwargs):
+        if len(sent) == 4:
+            raise RuntimeError('process killed')
+        return send(method, path, **kwargs)
+
+    monkeypatch.setattr(app.graph_client, 'request', dies_in_second_chunk)
+    with pytest.raises(RuntimeError):
+        app.run_broadcast(app.claim_broadcast('crashed'), 'crashed', pool)
+    crashed = row(store, broadcast)
+    assert crashed['last_contact_id'] == contact_id(phones()[2]) and crashed['sent'] == 3
+
+    # Nobody else takes it while its heartbeat is fresh
+    assert app.claim_broadcast('resumer') is None
+    with store:
+        store.execute('UPDATE broadcasts SET heartbeat_at = ?', (time.time() - app.BROADCAST_CLAIM_TIMEOUT - 1,))
+    monkeypatch.setattr(app.graph_client, 'request', send)
+    resumed = app.claim_broadcast('resumer')
+    assert resumed['id'] == broadcast
+    app.run_broadcast(resumed, 'resumer', pool)
+
+    sent_to = [to for to, _ in sent]
+    assert all(sent_to.count(phone) == 1 for phone in phones()[:3]) # Checkpointed chunk is not re-sent
+    assert set(sent_to) == set(phones())
+    done = row(store, broadcast)
+    assert (done['status'], done['sent']) == ('completed', 7)
+
+
+def test_resumed_chunk_skips_recipients_already_recorded(store, broadcast, sent, pool):
+    with store:
+        store.executemany('''
+            INSERT INTO broadcast_recipients (broadcast_id, phone_number, status, sent_at) VALUES (?, ?, 'sent', '')
+        ''', [(broadcast, phone) for phone in phones()[:2]])
+    app.run_broadcast(app.claim_broadcast('runner'), 'runner', pool)
+    assert [to for to, _ in sent] == phones()[2:]
+
+
+def test_runner_stops_when_its_broadcast_is_taken_over(store, broadcast, sent, pool, monkeypatch):
+    send = app.graph_client.request
+
+    def taken_over(method, path, **kwargs):
+        with app.get_store() as conn:
+            conn.execute("UPDATE broadcasts SET claimed_by = 'other'")
+        return send(method, path, **kwargs)
+
+    monkeypatch.setattr(app.graph_client, 'request', taken_over)
+    app.run_broadcast(app.claim_broadcast('runner'), 'runner', pool)
+    assert len(sent) == 3 # The first chunk only
+    stopped = row(store, broadcast)
+    # Its sends are counted, but the checkpoint belongs to the new owner
+    assert (stopped['status'], stopped['sent'], stopped['last_contact_id']) == ('running', 3, 0)
+    assert store.execute('SELECT COUNT(*) FROM broadcast_recipients').fetchone()[0] == 3
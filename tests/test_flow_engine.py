@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import app
+
+
+class TierAPI(BaseHTTPRequestHandler):
+    """GET /tier?phone=... answers {"tier": "gold"} for numbers ending in 1; /error answers 500."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/error':
+            self.send_response(500)
+            self.end_headers()
+            return
+        phone = parse_qs(url.query).get('phone', [''])[0]
+        body = json.dumps({"tier": "gold" if phone.endswith('1') else "basic"}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def api_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TierAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def onboarding(api_url, api_path='/tier?phone={{phone_number}}', fail_path=''):
+    """join -> welcome -> tier API -> gold/basic offer -> wait 60s -> ask."""
+    return {"steps": [
+        {"id": "start", "type": "trigger", "properties": {"keywords": "join", "keyword_join": "welcome"}},
+        {"id": "welcome", "type": "message", "properties": {"templateId": "welcome"}},
+        {"id": "tier", "type": "api", "properties": {"method": "GET", "url": api_url + api_path,
+                                                      "successPathId": "branch", "failPathId": fail_path}},
+        {"id": "branch", "type": "conditional_branch", "properties": {
+            "conditions": [{"variable": "api.body.tier", "operator": "equals", "value": "gold", "targetId": "gold"}],
+            "fallbackId": "basic"}},
+        {"id": "gold", "type": "message", "properties": {"templateId": "gold_offer", "nextStepId": "wait"}},
+        {"id": "basic", "type": "message", "properties": {"templateId": "basic_offer", "nextStepId": "wait"}},
+        {"id": "wait", "type": "wait_until", "properties": {"waitType": "duration", "duration": "1",
+                                                            "durationUnit": "minutes", "nextStepId": "ask"}},
+        {"id": "ask", "type": "message", "properties": {"templateId": "ask"}},
+    ]}
+
+
+def start(store, phone, text='join'):
+    with store:
+        app.handle_flow_message(store, phone, text)
+
+
+def run_due():
+    for session in app.claim_flow_sessions(10):
+        app._flow_slots.acquire() # advance_flow_session releases the slot it was dispatched with
+        app.advance_flow_session(session)
+
+
+def session(store, phone):
+    return store.execute('SELECT * FROM flow_sessions WHERE phone_number = ?', (phone,)).fetchone()
+
+
+def wake_now(store):
+    with store:
+        store.execute("UPDATE flow_sessions SET wake_at = 0 WHERE status = 'waiting'")
+
+
+def test_branches_on_the_api_response_and_waits(store, sent, api_url):
+    app.save_flow('onboarding', onboarding(api_url))
+    start(store, '9100000001')
+    start(store, '9100000002')
+    run_due()
+    assert sorted(sent) == [('9100000001', 'gold_offer'), ('9100000001', 'welcome'),
+                            ('9100000002', 'basic_offer'), ('9100000002', 'welcome')]
+    waiting = session(store, '9100000001')
+    assert (waiting['status'], waiting['node']) == ('waiting', 'ask')
+    assert waiting['wake_at'] > time.time() + 50
+    assert json.loads(waiting['variables'])['api'] == {"status": 200, "body": {"tier": "gold"}}
+
+    run_due() # Not due yet
+    assert len(sent) == 4
+    wake_now(store)
+    run_due()
+    assert sorted(sent[4:]) == [('9100000001', 'ask'), ('9100000002', 'ask')]
+    assert session(store, '9100000001')['status'] == 'done'
+
+
+def test_failed_api_call_without_fail_path_fails_the_session(store, sent, api_url):
+    app.save_flow('onboarding', onboarding(api_url, api_path='/error'))
+    start(store, '9100000001')
+    run_due()
+    failed = session(store, '9100000001')
+    assert failed['status'] == 'failed' and failed['last_error'] == 'API call failed (500)'
+    assert sent == [('9100000001', 'welcome')]
+
+
+def test_failed_api_call_follows_the_fail_path(store, sent, api_url):
+    app.save_flow('onboarding', onboarding(api_url, api_path='/error', fail_path='basic'))
+    start(store, '9100000001')
+    run_due()
+    assert sent == [('9100000001', 'welcome'), ('9100000001', 'basic_offer')]
+
+
+def test_oversized_api_response_is_not_kept(store, sent, api_url, monkeypatch):
+    monkeypatch.setattr(app, 'FLOW_API_MAX_BODY', 5)
+    app.save_flow('onboarding', onboarding(api_url))
+    start(store, '9100000001')
+    run_due()
+    waiting = session(store, '9100000001')
+    assert json.loads(waiting['variables'])['api'] == {"status": 200, "body": None}
+    assert ('9100000001', 'basic_offer') in sent # No body to branch on, so the fallback
+
+
+def test_session_of_a_dead_process_resumes_from_its_checkpoint(store, sent, api_url):
+    app.save_flow('onboarding', onboarding(api_url))
+    start(store, '9100000001')
+    run_due()
+    wake_now(store)
+    [claimed] = app.claim_flow_sessions(10) # This process "dies" while running the session
+    assert app.claim_flow_sessions(10) == []
+
+    with store:
+        store.execute('UPDATE flow_sessions SET claimed_at = ?', (time.time() - app.FLOW_CLAIM_TIMEOUT - 1,))
+    run_due()
+    assert [template for _, template in sent] == ['welcome', 'gold_offer', 'ask'] # Earlier steps are not repeated
+    assert session(store, '9100000001')['status'] == 'done'
+
+    # The dead process's late checkpoint cannot overwrite the new owner's progress
+    app.checkpoint_flow_session(claimed, 'welcome', {}, status='waiting')
+    assert (session(store, '9100000001')['status'], session(store, '9100000001')['node']) == ('done', 'ask')
@@ -0,0 +1,78 @@
+import json
+import multiprocessing
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'funnels.json')
+
+
+def repository(path):
+    return app.FunnelRepository(path, app.TriggerMatcher())
+
+
+def save_many(path, worker, count):
+    repo = repository(path)
+    for i in range(count):
+        repo.save(f'w{worker}-{i}', [{'delay': 0, 'template': 't'}])
+
+
+def test_save_and_delete_update_file_and_matcher(path):
+    repo = repository(path)
+    repo.save('hi', [{'delay': 0, 'template': 'welcome'}])
+    assert json.load(open(path)) == {'hi': [{'delay': 0, 'template': 'welcome'}]}
+    assert repo.matcher.match('hi') == 'hi'
+    assert repo.delete('hi') is True and repo.delete('hi') is False
+    assert json.load(open(path)) == {} and repo.matcher.match('hi') is None
+
+
+def test_concurrent_writers_do_not_lose_updates(path):
+    # Processes (not threads) so the flock is what serializes them
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=save_many, args=(path, worker, 20)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    assert len(json.load(open(path))) == 80
+
+
+def test_other_writers_changes_are_picked_up(path):
+    reader, writer = repository(path), repository(path)
+    reader.refresh(force=True)
+    writer.save('deal', {'match': 'prefix', 'steps': []})
+    reader.refresh(force=True)
+    assert reader.matcher.match('deal of the day') == 'deal'
+
+
+def test_crash_while_writing_keeps_the_previous_file(path, monkeypatch):
+    repo = repository(path)
+    repo.save('hi', [])
+
+    def crash(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(app.os, 'replace', crash)
+    with pytest.raises(OSError):
+        repo.save('new', [])
+    monkeypatch.undo()
+    assert json.load(open(path)) == {'hi': []}
+    assert repo.get('new') is None
+
+    # The lock was released, so the next save goes through
+    repo.save('new', [])
+    assert json.load(open(path)) == {'hi': [], 'new': []}
+
+
+def test_corrupt_file_is_not_overwritten(path):
+    with open(path, 'w') as f:
+        f.write('{"hi": [')
+    repo = repository(path)
+    with pytest.raises(OSError):
+        repo.save('new', [])
+    assert open(path).read() == '{"hi": ['
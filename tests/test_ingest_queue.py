@@ -0,0 +1,103 @@
+import json
+import time
+from datetime import datetime
+
+import pytest
+
+import app
+
+
+def webhook(phone, text, wamid):
+    return {"entry": [{"changes": [{"value": {
+        "metadata": {"phone_number_id": "P"},
+        "messages": [{"from": phone, "id": wamid, "type": "text", "text": {"body": text}}],
+    }}]}]}
+
+
+@pytest.fixture
+def funnel(monkeypatch):
+    """Every typed message triggers the 'promo' funnel of two steps."""
+    monkeypatch.setattr(app.funnel_repository, 'refresh', lambda force=False: None)
+    monkeypatch.setattr(app.trigger_matcher, 'match', lambda text, phone_number_id=None: 'promo')
+    monkeypatch.setattr(app.funnel_repository, 'get',
+                        lambda key: [{'delay': 60, 'template': 'a'}, {'delay': 120, 'template': 'b'}])
+
+
+def test_claim_takes_each_payload_once(store):
+    assert app.claim_webhook('w1') is None
+    app.enqueue_webhook('{"entry": []}')
+    row = app.claim_webhook('w1')
+    assert row['status'] == 'processing' and row['attempts'] == 1
+    assert app.claim_webhook('w2') is None
+
+
+def test_payload_of_a_dead_worker_is_claimed_again(store):
+    app.enqueue_webhook('{"entry": []}')
+    row = app.claim_webhook('dead')
+    app.release_stale_webhooks()
+    assert app.claim_webhook('w2') is None # Not stale yet
+
+    with store:
+        store.execute('UPDATE webhook_queue SET claimed_at = ? WHERE id = ?',
+                      (time.time() - app.INGEST_CLAIM_TIMEOUT - 1, row['id']))
+    app.release_stale_webhooks()
+    retried = app.claim_webhook('w2')
+    assert retried['id'] == row['id'] and retried['attempts'] == 2
+
+
+def test_old_failed_payloads_are_pruned(store):
+    old = datetime.fromtimestamp(time.time() - app.INGEST_FAILED_RETENTION - 60).isoformat()
+    with store:
+        store.execute("INSERT INTO webhook_queue (payload, received_at, status) VALUES ('old', ?, 'failed')", (old,))
+        store.execute("INSERT INTO webhook_queue (payload, received_at, status) VALUES ('new', ?, 'failed')",
+                      (datetime.now().isoformat(),))
+        store.execute("INSERT INTO webhook_queue (payload, received_at) VALUES ('pending', ?)", (old,))
+    app.release_stale_webhooks()
+    assert sorted(row[0] for row in store.execute('SELECT payload FROM webhook_queue')) == ['new', 'pending']
+
+
+def test_triggers_are_stored_with_the_message(store, funnel):
+    app.process_webhook_payload(webhook('911', 'promo please', 'wamid.in.1'))
+    assert store.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+    assert [row[0] for row in store.execute('SELECT template FROM scheduled_steps ORDER BY due_at')] == ['a', 'b']
+
+    # A redelivered payload neither stores the message nor schedules the funnel again
+    app.process_webhook_payload(webhook('911', 'promo please', 'wamid.in.1'))
+    assert store.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+    assert store.execute('SELECT COUNT(*) FROM scheduled_steps').fetchone()[0] == 2
+
+
+def test_crash_while_scheduling_triggers_rolls_back_the_message(store, funnel, monkeypatch):
+    def crash(conn, phone_number, text):
+        raise RuntimeError('worker died')
+
+    handle_flow_message = app.handle_flow_message
+    monkeypatch.setattr(app, 'handle_flow_message', crash)
+    with pytest.raises(RuntimeError):
+        app.process_webhook_payload(webhook('911', 'promo please', 'wamid.in.2'))
+    assert store.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+    assert store.execute('SELECT COUNT(*) FROM scheduled_steps').fetchone()[0] == 0
+
+    # The retry therefore still fires the funnel
+    monkeypatch.setattr(app, 'handle_flow_message', handle_flow_message)
+    app.process_webhook_payload(webhook('911', 'promo please', 'wamid.in.2'))
+    assert store.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+    assert store.execute('SELECT COUNT(*) FROM scheduled_steps').fetchone()[0] == 2
+
+
+def test_worker_retries_failed_payloads_then_gives_up(store, monkeypatch):
+    attempts = []
+
+    def flaky(data):
+        attempts.append(data)
+        raise RuntimeError('store unavailable')
+
+    monkeypatch.setattr(app, 'process_webhook_payload', flaky)
+    app.enqueue_webhook(json.dumps(webhook('911', 'hi', 'wamid.in.3')))
+    for _ in range(app.INGEST_MAX_ATTEMPTS):
+        row = app.claim_webhook('w1')
+        assert row is not None
+        app.process_claimed_webhook(row)
+    assert len(attempts) == app.INGEST_MAX_ATTEMPTS
+    assert app.claim_webhook('w1') is None
+    assert store.execute('SELECT status FROM webhook_queue').fetchone()[0] == 'failed'
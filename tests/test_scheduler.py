@@ -0,0 +1,112 @@
+import time
+
+import requests
+
+import app
+
+
+def schedule(store, *steps, phone='911', funnel='promo'):
+    with store:
+        app.schedule_funnel_steps(store, phone, funnel, list(steps))
+
+
+def run(step):
+    app._scheduler_slots.acquire() # run_scheduled_step releases the slot it was dispatched with
+    app.run_scheduled_step(step)
+
+
+def expire_claims(store):
+    with store:
+        store.execute('UPDATE scheduled_steps SET claimed_at = ?', (time.time() - app.SCHEDULER_CLAIM_TIMEOUT - 1,))
+
+
+def status(store):
+    return [tuple(row) for row in store.execute('SELECT template, status, attempts FROM scheduled_steps ORDER BY id')]
+
+
+def test_only_due_steps_are_claimed_once(store):
+    schedule(store, {'delay': 0, 'template': 'now'}, {'delay': 3600, 'template': 'later'})
+    claimed = app.claim_due_steps(10)
+    assert [step['template'] for step in claimed] == ['now']
+    assert app.claim_due_steps(10) == []
+
+
+def test_sent_step_is_recorded(store, sent):
+    schedule(store, {'delay': 0, 'template': 'welcome'})
+    [step] = app.claim_due_steps(10)
+    run(step)
+    assert sent == [('911', 'welcome')]
+    assert status(store) == [('welcome', 'sent', 1)]
+
+
+def test_failed_send_is_retried_later_then_given_up(store, sent, monkeypatch):
+    monkeypatch.setattr(app.template_catalog, 'validate', lambda name, language="en_US": "Template 'x' does not exist")
+    schedule(store, {'delay': 0, 'template': 'x'})
+    for attempt in range(1, app.SCHEDULER_MAX_ATTEMPTS + 1):
+        with store:
+            store.execute('UPDATE scheduled_steps SET due_at = 0')
+        [step] = app.claim_due_steps(10)
+        run(step)
+        if attempt < app.SCHEDULER_MAX_ATTEMPTS:
+            assert status(store) == [('x', 'pending', attempt)]
+            assert app.claim_due_steps(10) == [] # Backed off by SCHEDULER_RETRY_DELAY
+    assert status(store) == [('x', 'failed', app.SCHEDULER_MAX_ATTEMPTS)]
+    assert sent == []
+
+
+def test_step_of_a_dead_process_is_sent_by_the_next_claim(store, sent):
+    schedule(store, {'delay': 0, 'template': 'welcome'})
+    assert len(app.claim_due_steps(10)) == 1 # This process "dies" before sending
+    assert app.claim_due_steps(10) == []
+
+    expire_claims(store)
+    [step] = app.claim_due_steps(10)
+    assert step['attempts'] == 2
+    run(step)
+    assert sent == [('911', 'welcome')]
+    assert status(store) == [('welcome', 'sent', 2)]
+
+
+def test_step_reclaimed_while_waiting_for_the_rate_limit_is_not_sent_twice(store, sent, monkeypatch):
+    schedule(store, {'delay': 0, 'template': 'welcome'})
+    [slow] = app.claim_due_steps(10)
+
+    # Another process takes the step over (and sends it) while this one waits for a token
+    takeovers = []
+
+    def acquire(bucket):
+        if not takeovers:
+            expire_claims(store)
+            takeovers.extend(app.claim_due_steps(10))
+            run(takeovers[0])
+
+    monkeypatch.setattr(app.TokenBucket, 'acquire', acquire)
+    run(slow)
+    assert sent == [('911', 'welcome')]
+    assert status(store) == [('welcome', 'sent', 2)]
+
+
+def test_claim_is_renewed_right_before_sending(store, sent, monkeypatch):
+    schedule(store, {'delay': 0, 'template': 'welcome'})
+    [step] = app.claim_due_steps(10)
+    claimed_at = []
+
+    def request(method, path, **kwargs):
+        claimed_at.append(store.execute('SELECT claimed_at FROM scheduled_steps WHERE id = ?', (step['id'],)).fetchone()[0])
+        raise requests.exceptions.ConnectionError('stop here')
+
+    monkeypatch.setattr(app.graph_client, 'request', request)
+    assert not app.send_whatsapp_template('911', 'welcome', before_send=lambda: app.renew_step_claim(step))
+    assert claimed_at[0] > step['claimed_at']
+
+
+def test_old_finished_steps_are_pruned(store):
+    schedule(store, {'delay': 0, 'template': 'old'}, {'delay': 0, 'template': 'kept'}, {'delay': 0, 'template': 'due'})
+    with store:
+        store.execute("UPDATE scheduled_steps SET status = 'sent', due_at = ? WHERE template = 'old'",
+                      (time.time() - app.SCHEDULER_RETENTION - 60,))
+        store.execute("UPDATE scheduled_steps SET status = 'failed' WHERE template = 'kept'")
+        store.execute("UPDATE scheduled_steps SET due_at = ? WHERE template = 'due'",
+                      (time.time() - app.SCHEDULER_RETENTION - 60,))
+    app.prune_scheduled_steps()
+    assert [row[0] for row in status(store)] == ['kept', 'due']
@@ -0,0 +1,103 @@
+import json
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def legacy(tmp_path, monkeypatch):
+    """Points the legacy files and the log at tmp_path; returns that directory."""
+    monkeypatch.setattr(app, 'MESSAGES_FILE', str(tmp_path / 'messages.json'))
+    monkeypatch.setattr(app, 'LEGACY_LOG_FILE', str(tmp_path / 'log.json'))
+    monkeypatch.setattr(app, 'LOG_FILE', str(tmp_path / 'log.jsonl'))
+    monkeypatch.setattr(app, 'log_writer', app.LogWriter(str(tmp_path / 'log.jsonl'), app.LOG_MAX_BYTES,
+                                                         app.LOG_MAX_AGE, app.LOG_BACKUP_COUNT))
+    return tmp_path
+
+
+def migrate(path):
+    conn = app.connect_db(str(path))
+    app.apply_migrations(conn, app.STORE_MIGRATIONS, schema=app.STORE_SCHEMA)
+    return conn
+
+
+def test_legacy_files_are_imported_once_and_renamed(legacy):
+    (legacy / 'messages.json').write_text(json.dumps({
+        '911': [{'text': 'hi', 'timestamp': '2024-01-01T00:00:00', 'isFromMe': False},
+                {'text': 'hello', 'timestamp': '2024-01-01T00:01:00', 'isFromMe': True}],
+    }))
+    (legacy / 'log.json').write_text(json.dumps([{'timestamp': '2024-01-01T00:00:00', 'level': 'INFO', 'message': 'old'}]))
+
+    conn = migrate(legacy / 'store.db')
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(app.STORE_MIGRATIONS)
+    assert [row['text'] for row in conn.execute('SELECT text FROM messages ORDER BY id')] == ['hi', 'hello']
+    assert conn.execute('SELECT last_message FROM chats').fetchone()[0] == 'hello'
+    assert not (legacy / 'messages.json').exists() and (legacy / 'messages.json.migrated').exists()
+    assert not (legacy / 'log.json').exists() and (legacy / 'log.json.migrated').exists()
+    assert json.loads((legacy / 'log.jsonl.1').read_text())['message'] == 'old'
+
+    # Opening the store again finds nothing left to do
+    migrate(legacy / 'store.db')
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 2
+
+
+def test_missing_or_corrupt_legacy_files_do_not_block_migration(legacy):
+    (legacy / 'messages.json').write_text('{not json')
+    conn = migrate(legacy / 'store.db')
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(app.STORE_MIGRATIONS)
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+    assert (legacy / 'messages.json.migrated').exists()
+
+
+def test_failed_migration_rolls_back_and_is_retried(tmp_path):
+    applied = []
+
+    def first(conn):
+        conn.execute('CREATE TABLE t (x)')
+        applied.append('first')
+
+    def crashes(conn):
+        conn.execute('INSERT INTO t VALUES (1)')
+        raise RuntimeError('crash mid-migration')
+
+    conn = app.connect_db(str(tmp_path / 'db'))
+    with pytest.raises(RuntimeError):
+        app.apply_migrations(conn, [first, crashes])
+    # The first migration is committed, the crashed one left no trace
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+
+    app.apply_migrations(conn, [first, lambda conn: conn.execute('INSERT INTO t VALUES (2)')])
+    assert applied == ['first']
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 2
+    assert [row[0] for row in conn.execute('SELECT x FROM t')] == [2]
+
+
+def test_concurrent_openers_apply_each_migration_once(tmp_path):
+    applied = []
+    lock = threading.Lock()
+
+    def counted(name):
+        def migration(conn):
+            with lock:
+                applied.append(name)
+        return migration
+
+    migrations = [counted('a'), counted('b'), counted('c')]
+    errors = []
+
+    def open_store():
+        try:
+            app.apply_migrations(app.connect_db(str(tmp_path / 'db')), migrations)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=open_store) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(applied) == ['a', 'b', 'c']
@@ -0,0 +1,104 @@
+import pytest
+
+from app import KeywordAutomaton, TriggerMatcher
+
+
+@pytest.fixture
+def matcher():
+    return TriggerMatcher()
+
+
+def test_legacy_step_list_is_an_exact_keyword(matcher):
+    matcher.add('hi', [{'delay': 0, 'template': 'welcome'}])
+    assert matcher.match('  HI ') == 'hi'
+    assert matcher.match('hi there') is None
+
+
+def test_match_types(matcher):
+    matcher.add('price', {'match': 'prefix', 'steps': []})
+    matcher.add('offer', {'match': 'contains', 'steps': []})
+    matcher.add('order', {'match': 'regex', 'pattern': r'order #?\d+', 'steps': []})
+    assert matcher.match('Price list please') == 'price'
+    assert matcher.match('any offer today?') == 'offer'
+    assert matcher.match('where is order #42') == 'order'
+    assert matcher.match('nothing here') is None
+
+
+def test_longest_prefix_wins(matcher):
+    matcher.add('buy', {'match': 'prefix', 'steps': []})
+    matcher.add('buy now', {'match': 'prefix', 'steps': []})
+    assert matcher.match('buy now please') == 'buy now'
+    assert matcher.match('buy later') == 'buy'
+    matcher.remove('buy now')
+    assert matcher.match('buy now please') == 'buy'
+
+
+def test_contains_only_matches_whole_words(matcher):
+    matcher.add('hi', {'match': 'contains', 'steps': []})
+    assert matcher.match('oh hi!') == 'hi'
+    assert matcher.match('this is nothing') is None
+
+
+def test_shared_exact_pattern_survives_removing_one_funnel(matcher):
+    matcher.add('hi', [])
+    matcher.add('greeting', {'match': 'exact', 'pattern': 'hi', 'steps': []})
+    assert matcher.match('hi') == 'greeting' # Alphabetically first of the two
+    matcher.remove('greeting')
+    assert matcher.match('hi') == 'hi'
+    matcher.remove('hi')
+    assert matcher.match('hi') is None
+
+
+@pytest.mark.parametrize('match_type', ['prefix', 'contains'])
+def test_shared_pattern_survives_removing_one_funnel(matcher, match_type):
+    matcher.add('a', {'match': match_type, 'pattern': 'promo', 'steps': []})
+    matcher.add('b', {'match': match_type, 'pattern': 'promo', 'steps': []})
+    assert matcher.match('promo') == 'a'
+    matcher.remove('a')
+    assert matcher.match('promo') == 'b'
+    matcher.remove('b')
+    assert matcher.match('promo') is None
+
+
+def test_regex_is_case_insensitive(matcher):
+    matcher.add('sale', {'match': 'regex', 'pattern': r'\bSALE\b', 'steps': []})
+    assert matcher.match('Big sale today') == 'sale'
+
+
+def test_replacing_a_funnel_drops_its_old_rule(matcher):
+    matcher.add('deal', {'match': 'contains', 'pattern': 'deal', 'steps': []})
+    matcher.add('deal', {'match': 'exact', 'pattern': 'deal', 'steps': []})
+    assert matcher.match('great deal') is None
+    assert matcher.match('deal') == 'deal'
+
+
+def test_tenant_rules_fall_back_to_global(matcher):
+    matcher.add('hi', [])
+    matcher.add('hello', {'match': 'exact', 'pattern': 'hi', 'phone_number_id': '111', 'steps': []})
+    assert matcher.match('hi', '111') == 'hello'
+    assert matcher.match('hi', '222') == 'hi'
+    assert matcher.match('hi') == 'hi'
+
+
+@pytest.mark.parametrize('spec', [
+    {'match': 'fuzzy'},
+    {'match': 'regex', 'pattern': '(unclosed'},
+    {'match': 'regex', 'pattern': '(?P<name>x)'},
+    {'match': 'regex', 'pattern': r'(a)\1'},
+    {'match': 'regex', 'pattern': 'a(?i)b'},
+])
+def test_invalid_rules_are_rejected(matcher, spec):
+    with pytest.raises(ValueError):
+        matcher.add('bad', spec)
+    assert 'bad' not in matcher.rules
+
+
+def test_automaton_finds_overlapping_keywords():
+    automaton = KeywordAutomaton()
+    for keyword, funnel_key in (('he', 'f1'), ('she', 'f2'), ('hers', 'f3'), ('his', 'f4')):
+        automaton.add(keyword, funnel_key)
+    assert automaton.search('ushers') is None # Only substrings, no whole words
+    assert automaton.search('so she said') == 'f2'
+    assert automaton.search('it is hers') == 'f3'
+    automaton.remove('hers', 'f3')
+    assert automaton.search('it is hers') is None